@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+'''
+Pre-preprocessor benchmark.
+GPLv3
+
+Writes a large include file of mostly plain instructions, with the odd
+conditional, INSERT and 'set'/'equ' line in it like the generated ISR and table
+files, and times the pre-preprocessor programs given on it, without chaining to
+the assembler and without the include cache.  Reports lines per second, the
+best of a few runs, the peak memory used and the size of the interim file.
+With '--project' it runs on a whole synthetic project from workload.py instead,
+taking its settings, such as '--levels=N' or '--generate=N', where '--lines=N'
+is the plain lines in each file.  With
+'--startup' it times starting the programs instead, with '--version', next to
+starting the interpreter with nothing to do.
+
+With '--baseline=file' the results are compared to the ones stored in the
+file for the same workload, and with '--save' the results of the first
+program are stored there.
+
+Programs given with '--plain=program.py', such as the original mpasme.py, are
+run with only the source file, as they don't know the options above, from a
+copy with 'mpasm_prog' set to None so they don't chain to the assembler.
+They are left out of '--startup'.  The interim file and the files kept next
+to it are removed before each run, so none of the programs can reuse the
+last one's, and a run taking more than '--limit=N' seconds, 300 by default,
+is stopped and counted as failed, as the older programs don't finish on some
+of the '--project' workloads.
+
+  benchmark.py [--lines=N] [--runs=N] [--startup] [--project [--setting=N]]
+               [--baseline=file [--save]] [--plain=program.py ...]
+               [--limit=N]
+               [program.py ...]
+
+The default program is the mpasme.py next to this file.
+'''
+
+
+import sys, os, subprocess, time, tempfile, shutil, json, threading
+import workload
+
+lines = 200000
+lines_given = False
+runs = 3
+startup = False
+project = False
+settings = {}
+baseline = None
+save = False
+programs = []
+plain_programs = []
+limit = 300
+
+for entry in sys.argv[1:]:
+  if entry[:8] == '--lines=':
+    lines = int(entry[8:])
+    lines_given = True
+  elif entry[:7] == '--runs=':
+    runs = int(entry[7:])
+  elif entry == '--startup':
+    startup = True
+  elif entry == '--project':
+    project = True
+  elif entry[:11] == '--baseline=':
+    baseline = entry[11:]
+  elif entry == '--save':
+    save = True
+  elif entry[:8] == '--plain=':
+    plain_programs.append(os.path.abspath(entry[8:]))
+  elif entry[:8] == '--limit=':
+    limit = float(entry[8:])
+  elif entry[:2] == '--' and entry[2:].partition('=')[0] in workload.defaults:
+    name, sep, value = entry[2:].partition('=')
+    settings[name] = int(value)
+  else:
+    programs.append(os.path.abspath(entry))
+
+# with '--project' the line count is the workload's, of each file
+if project and lines_given:
+  settings['lines'] = lines
+
+if not programs:
+  programs.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'mpasme.py'))
+
+# -----------------------------------------------------------------------------
+def write_workload(directory):
+
+  with open(os.path.join(directory, 'bench_table.inc'), 'w') as f:
+    f.write('#INSERT bench_isr bench_section 10\n')
+    for count in range(lines):
+      if count % 1000 == 0:
+        f.write('#ifdef bench_option_' + str(count % 7) + '\n')
+      elif count % 1000 == 500:
+        f.write('#endif\n')
+      elif count % 100 == 50:
+        f.write('bench_value_' + str(count) + ' equ 0x' + \
+                format(count % 256, '02X') + '\n')
+      elif count % 3 == 0:
+        f.write('\tmovlw\t0x' + format(count % 256, '02X') + \
+                '\t; table entry ' + str(count) + '\n')
+      elif count % 3 == 1:
+        f.write('\tmovwf\tPOSTINC0\n')
+      else:
+        f.write('bench_label_' + str(count) + '\n')
+
+  with open(os.path.join(directory, 'bench_top.asm'), 'w') as f:
+    f.write('#define bench_option_3\n')
+    f.write('bench_isr macro\n\tnop\n\tendm\n')
+    f.write('#include bench_table.inc\n')
+    f.write('#SECTION bench_section\n')
+    f.write('\tend\n')
+
+# ----------------------------------------------
+def plain_copy(program, directory):
+  
+  # a copy of the program that doesn't chain to the assembler, in the
+  # directory, None if it has no 'mpasm_prog' line to change
+  with open(program, 'r') as f:
+    lines = f.readlines()
+  found = False
+  for index, line in enumerate(lines):
+    if line.startswith('mpasm_prog = '):
+      lines[index] = 'mpasm_prog = None\n'
+      found = True
+  if not found:
+    return None
+  copy = os.path.join(directory, '_plain_' + str(len(os.listdir(directory))) + \
+                      '_' + os.path.basename(program))
+  with open(copy, 'w') as f:
+    f.writelines(lines)
+  return copy
+
+# -----------------------------------------------------------------------------
+def measure(command, cwd=None, name=None):
+  
+  # returns the best time of the runs and the peak memory used in kB, None if
+  # not known, or None if it failed, told under the name, the program if None
+  name = name or command[1]
+  best = None
+  peak = None
+  for run in range(runs):
+    # nothing left from the last run, such as a manifest, to be reused
+    if cwd is not None:
+      for left in os.listdir(cwd):
+        if left.startswith('_pre_processed_file.asm'):
+          os.remove(os.path.join(cwd, left))
+    start = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=cwd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    timer = threading.Timer(limit, proc.kill)
+    timer.start()
+    if hasattr(os, 'wait4'):
+      # the child's own resource use, ru_maxrss is in kB on Linux
+      status, usage = os.wait4(proc.pid, 0)[1:]
+      proc.returncode = os.waitstatus_to_exitcode(status)
+      peak = max(peak or 0, usage.ru_maxrss)
+    else:
+      proc.wait()
+    elapsed = time.perf_counter() - start
+    timer.cancel()
+    if elapsed >= limit:
+      print(name + ': stopped after ' + format(limit, 'g') + ' s')
+      return None
+    if proc.returncode != 0:
+      print(name + ': failed with exit code ' + str(proc.returncode))
+      return None
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, peak
+
+# ----------------------------------------------
+def compare(result, stored):
+  
+  # the change from the stored result, as text
+  changes = []
+  for name, label in [['lines_per_second', 'speed'], ['peak_kb', 'memory'],
+                      ['output_bytes', 'output'], ]:
+    if result[name] and stored.get(name):
+      change = 100.0 * result[name] / stored[name] - 100
+      changes.append(label + ' ' + format(change, '+.1f') + '%')
+  return ', '.join(changes)
+
+# -----------------------------------------------------------------------------
+
+if startup:
+  best = measure([sys.executable, '-c', 'pass', ])[0]
+  print('interpreter: ' + format(best * 1000, '.1f') + ' ms')
+  for program in programs:
+    result = measure([sys.executable, program, '--version', ])
+    if result is not None:
+      print(program + ': ' + format(result[0] * 1000, '.1f') + ' ms')
+  sys.exit(0)
+
+directory = tempfile.mkdtemp(prefix='mpasme_bench_')
+if project:
+  top, lines = workload.write_project(directory, **settings)
+  key = 'project ' + ' '.join([name + '=' + str(value) for name, value in \
+                               sorted(dict(workload.defaults,
+                                           **settings).items())])
+else:
+  write_workload(directory)
+  top = 'bench_top.asm'
+  key = 'lines=' + str(lines)
+
+stored = {}
+if baseline and os.path.exists(baseline):
+  with open(baseline, 'r') as f:
+    stored = json.load(f)
+
+runs_of = []
+for program in programs:
+  runs_of.append([program, [sys.executable, program, top, '--no-chain',
+                            '--no-cache', '--rebuild', ]])
+for program in plain_programs:
+  copy = plain_copy(program, directory)
+  if copy is None:
+    print(program + ': no mpasm_prog line to stop it chaining to the ' + \
+          'assembler')
+    continue
+  runs_of.append([program + ' (plain)', [sys.executable, copy, top, ]])
+
+results = []
+for program, command in runs_of:
+  result = measure(command, directory, program)
+  if result is None:
+    continue
+  best, peak = result
+  results.append({'lines_per_second': lines / best, 'peak_kb': peak,
+                  'output_bytes': os.path.getsize(os.path.join(directory,
+                                    '_pre_processed_file.asm')), })
+  print(program + ': ' + str(lines) + ' lines in ' + \
+        format(best, '.3f') + ' s, ' + format(lines / best, ',.0f') + \
+        ' lines/s' + \
+        ('' if peak is None else ', peak ' + format(peak / 1024, '.1f') + \
+         ' MB') + ', ' + format(results[-1]['output_bytes'], ',') + \
+        ' bytes out')
+  if key in stored:
+    print('  against the baseline: ' + compare(results[-1], stored[key]))
+
+shutil.rmtree(directory, ignore_errors=True)
+
+if save and baseline and results:
+  stored[key] = results[0]
+  with open(baseline, 'w') as f:
+    json.dump(stored, f, indent=1, sort_keys=True)
+    f.write('\n')
+  print('saved as the baseline for ' + key + ' in ' + baseline)
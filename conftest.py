@@ -0,0 +1,2 @@
+# if_nesting_test.py is a program that runs when imported, not tests
+collect_ignore = ['if_nesting_test.py', ]
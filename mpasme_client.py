@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+'''
+Client for the pre-preprocessor daemon.
+GPLv3
+
+With 'mpasme.py --daemon' running, put this file in place of the 'mpasmx'
+program instead of mpasme.py, next to mpasme.py and mpasme_core.py or linked
+to it.  It hands its arguments, working directory and standard streams to the
+daemon, which does the build, and exits with its exit code.  When the daemon
+is not running it runs mpasme.py itself, imported the same way mpasme.py
+imports mpasme_core.py, so its compiled copy is used.
+'''
+
+
+import sys, os, socket, json
+
+program = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       'mpasme.py')
+daemon_socket = os.environ.get('MPASME_SOCKET', os.path.join(
+                  os.path.expanduser('~'), '.cache', 'mpasme', 'daemon.sock'))
+
+# -----------------------------------------------------------------------------
+def run_directly():
+
+  sys.path.insert(0, os.path.dirname(program))
+  import mpasme
+  mpasme.main()
+  sys.exit(0)
+
+# -----------------------------------------------------------------------------
+
+try:
+  conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  conn.connect(daemon_socket)
+except (AttributeError, OSError):
+  run_directly()
+
+request = json.dumps({'argv': sys.argv[1:], 'cwd': os.getcwd(), }) + '\n'
+try:
+  socket.send_fds(conn, [request.encode(), ], [0, 1, 2, ])
+except OSError:
+  conn.close()
+  run_directly()
+
+reply = b''
+while not reply.endswith(b'\n'):
+  data = conn.recv(64)
+  if not data:
+    break
+  reply += data
+reply = reply.decode().split()
+
+if reply == ['restart', ]:
+  run_directly()
+if len(reply) != 2 or reply[0] != 'exit':
+  print('PRE-PREPROCESSOR ERROR: no reply from daemon', file=sys.stderr)
+  sys.exit(1)
+sys.exit(int(reply[1]))
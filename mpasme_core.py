@@ -0,0 +1,3900 @@
+#!/usr/bin/env python3
+
+'''
+Microchip MPASM assembler preprocessor.
+c2018  Trevor Marvin  GPLv3
+
+Edit this file to contain paths to your MPASM binary below.
+
+This is the program itself, mpasme.py next to it is what is run in place of
+the original 'mpasmx' program and imports this, so its compiled copy is kept
+and starting up is quick.
+
+It can also be imported by other programs, see the Preprocessor class.
+'''
+
+
+import sys, os, io, heapq, bisect, stat, errno
+# the rest are imported where they are used, so starting up is quick
+
+program_version = '1.1'
+mpasm_prog = '/opt/microchip/mplabx/v5.05/mpasmx/mpasmx_orig'
+default_interim_file = '_pre_processed_file.asm'
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'mpasme')
+default_result_cache_size = 512 * 1024 * 1024  # oldest results dropped past it
+interim_file = default_interim_file
+manifest_file = interim_file + '.manifest'
+source_map_file = interim_file + '.map'
+analysis_file = interim_file + '.analysis'
+stats_file = interim_file + '.stats'
+cache_dir = default_cache_dir
+result_cache_size = default_result_cache_size
+daemon_socket = os.environ.get('MPASME_SOCKET', os.path.join(
+                  os.path.expanduser('~'), '.cache', 'mpasme', 'daemon.sock'))
+inputfilename = None
+inputfilenames = []
+jobs = 1
+options = {}
+passed_options = []
+errfile = None
+script_file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                           'mpasme.py')   # run for builds started from this one
+
+def parse_arguments(argv):
+  
+  # options for this program are given as '--name' or '--name=value' and are
+  # not passed on to MPASM, nor is '-j N'
+  
+  global inputfilename, inputfilenames, jobs, options, passed_options, \
+         interim_file, cache_dir, result_cache_size, manifest_file, \
+         source_map_file, analysis_file, stats_file, errfile, cache_hits, \
+         cache_misses
+  
+  # nothing is kept from an earlier call, main() can be run again
+  inputfilename = None
+  inputfilenames = []
+  jobs = 1
+  options = {}
+  passed_options = []
+  interim_file = default_interim_file
+  cache_dir = default_cache_dir
+  result_cache_size = default_result_cache_size
+  errfile = None
+  cache_hits = 0
+  cache_misses = 0
+  
+  arguments = list(argv)
+  while arguments:
+    entry = arguments.pop(0)
+    if entry[:2] == '--':
+      name, sep, value = entry[2:].partition('=')
+      options[name.lower()] = value if sep else True
+      continue
+    if entry[:2] == '-j':
+      if entry[2:]:
+        jobs = int(entry[2:])
+      elif arguments and arguments[0].isdigit():
+        jobs = int(arguments.pop(0))
+      else:
+        jobs = os.cpu_count() or 1
+      continue
+    if entry[:1] == '-':
+      passed_options.append(entry)
+      continue     # skip options, but will pass to MPASM later
+    if inputfilename is None:
+      inputfilename = entry
+    inputfilenames.append(entry)
+  
+  if 'jobs' in options:
+    jobs = int(options['jobs'])
+  if options.get('interim') == 'auto':
+    interim_file = auto_interim()
+  elif 'interim' in options:
+    interim_file = options['interim']
+  if 'interim-dir' in options:
+    interim_file = os.path.join(options['interim-dir'], interim_file)
+  
+  if 'cache-dir' in options:
+    cache_dir = options['cache-dir']
+  if 'no-cache' in options:
+    cache_dir = None
+  if 'result-cache-size' in options:
+    result_cache_size = int(options['result-cache-size']) * 1024 * 1024
+  
+  # kept next to the interim file
+  manifest_file = interim_file + '.manifest'
+  source_map_file = interim_file + '.map'
+  analysis_file = interim_file + '.analysis'
+  if options.get('analyze', True) is not True:
+    analysis_file = options['analyze']
+  stats_file = interim_file + '.stats'
+  if options.get('stats', True) is not True:
+    stats_file = options['stats']
+
+# ----------------------------------------------
+def auto_interim():
+  
+  import hashlib
+  
+  # named after the file and what is built from it, so builds of other files
+  # or with other options in the same directory each have their own, and the
+  # same build finds the one it wrote last time
+  filename = (inputfilename or 'file').strip('"')
+  name = os.path.basename(filename).split('.')[0]
+  digest = hashlib.sha1(repr([os.path.abspath(filename), manifest_options(),
+                              passed_options, ]).encode())
+  return '_pre_processed_' + name + '_' + digest.hexdigest()[:8] + '.asm'
+
+# -----------------------------------------------------------------------------
+# source files are read through here, which keeps a cache on disk of the split
+# up lines of each file so unchanged framework files are not tokenized again on
+# every build
+
+cache_version = 5
+cache_hits = 0
+cache_misses = 0
+memory_cache = {}   # entries already loaded, by absolute path, kept by --daemon
+
+# directives that are handled before a 'set' or 'equ' in the same line
+conditional_directives = ['#endif', '#else', '#if', '#ifdef', '#ifndef',
+                          '#define', ]
+# MPASM directives without a '#' that matter to working out #IF expressions
+plain_directives = ['if', 'ifdef', 'ifndef', 'else', 'endif', 'while', 'endw',
+                    'endm', 'radix', 'list', 'variable', 'constant', ]
+# only lines with one of these in them can be a directive or 'set' or 'equ',
+# or set a variable, kept short since each one is a search through the file
+candidate_words = ['#', 'set', 'equ', 'if', 'while', 'macro', 'radix', '=',
+                   '+', '-', ]
+# and these, only searched for when one of the words they close is in the
+# file, ENDIF is found by 'if' already
+closing_words = [['else', ['if', ]], ['end', ['macro', 'while', ]], ]
+# the line breaks str.splitlines() splits at besides '\n'
+other_breaks = '\v\f\x1c\x1d\x1e\x85\u2028\u2029'
+assignment_pattern = r'^\s*([A-Za-z_?][\w?]*)\s*' + \
+                     r'(\+\+|--|<<=|>>=|[-+*/%&|^]?=(?!=))(.*)$'
+
+def split_line(line, tokens, index):
+  
+  if ';' in line:
+    line = line.split(';', 1)[0]  # remove comment
+  pieces = line.split()
+  if len(pieces) == 0:
+    return
+  keyword = pieces[0].lower()
+  setequ = (len(pieces) > 2) and (pieces[1].lower() in ['set', 'equ', ])
+  if keyword[:1] == '#' and (keyword in conditional_directives or not setequ):
+    tokens[index] = (pieces, keyword)
+  elif setequ:
+    tokens[index] = (pieces, pieces[1].lower())
+  elif keyword in plain_directives:
+    tokens[index] = (pieces, keyword)
+  elif len(pieces) > 1 and pieces[1].lower() == 'macro':
+    tokens[index] = (pieces, 'macro')
+  elif '=' in line or '++' in line or '--' in line:
+    import re
+    match = re.match(assignment_pattern, line)
+    if match:
+      # the variable, the operator and the expression
+      tokens[index] = ([match.group(1), match.group(2), ] + \
+                       match.group(3).split(), 'assign')
+
+# ----------------------------------------------
+def split_lines(lines, text=None):
+  
+  # returns the split up pieces and the keyword to look up the handler with,
+  # by line index, for the lines that may be directives, 'text' is the lines
+  # joined up when it is at hand
+  tokens = {}
+  if text is None:
+    text = ''.join(lines)
+  lowered = text.lower()
+  if len(lowered) != len(text):
+    # some character changed length, so positions can't be shared
+    for index, line in enumerate(lines):
+      split_line(line, tokens, index)
+    return tokens
+  
+  # only split up the lines with a candidate word in them, the next place of
+  # each word is kept, nearest first, so the text is only searched through
+  # once
+  places = dict((word, lowered.find(word)) for word in candidate_words)
+  for word, opening in closing_words:
+    if max(places[other] for other in opening) >= 0:
+      places[word] = lowered.find(word)
+  nexts = [(place, word) for word, place in places.items() if place >= 0]
+  heapq.heapify(nexts)
+  index = 0
+  position = 0
+  while nexts:
+    start = nexts[0][0]
+    index += text.count('\n', position, start)
+    position = text.find('\n', start)
+    if position < 0:
+      position = len(text)
+    split_line(lines[index], tokens, index)
+    while nexts and nexts[0][0] < position:
+      word = nexts[0][1]
+      place = lowered.find(word, position)
+      if place < 0:
+        heapq.heappop(nexts)
+      else:
+        heapq.heapreplace(nexts, (place, word))
+  return tokens
+
+# ----------------------------------------------
+def summarize(tokens):
+  
+  # what the lines may change that #IF expressions depend on, for files that
+  # are not read here: the names they set, the files they include and whether
+  # they change the radix
+  assigns = set()
+  includes = []
+  radix = False
+  for pieces, keyword in tokens.values():
+    if keyword in ['set', 'equ', 'assign', ]:
+      assigns.add(pieces[0])
+    elif keyword in ['#define', '#undefine', ] and len(pieces) > 1:
+      assigns.add(pieces[1])
+    elif keyword in ['variable', 'constant', ]:
+      for part in ' '.join(pieces[1:]).split(','):
+        name = part.split('=', 1)[0].strip()
+        if name:
+          assigns.add(name)
+    elif keyword == 'radix' or (keyword == 'list' and \
+                                'r=' in ''.join(pieces[1:]).lower()):
+      radix = True
+    elif keyword == '#include' and len(pieces) > 1:
+      includes.append(pieces[1].strip('<>'))
+  return [sorted(assigns), includes, radix]
+
+# ----------------------------------------------
+# the words a line that makes an included file be expanded starts with, as
+# searched for, and in full
+special_words = [b'#insert', b'#section', b'#generate', b'#splice',
+                 b'#endsplice', b';#sectioninsert_force_expansion', ]
+special_keywords = set([b'#insert', b'#section', b'#generate',
+                        b'#splicebefore', b'#splicebetween', b'#spliceafter',
+                        b'#spliceempty', b'#endsplice',
+                        b';#sectioninsert_force_expansion', ])
+# for a file that is passed over, the lines that could set a symbol, as
+# matched after a newline in its lower case bytes, and the words the lines
+# that could include a file or change the radix start with
+assigned_pattern = rb'[\r\n][^\S\r\n]*([^\s;]+)(?:[^\S\r\n]+(?:set|equ)' + \
+                   rb'(?![^\s;])|[^\S\r\n]*(?:\+\+|--|<<=|>>=|[-+*/%&|^]?=))'
+once_keyword = b';#sectioninsert_include_once'
+summary_words = [b'#define', b'#undefine', b'#include', b'variable',
+                 b'constant', b'radix', b'list', ]
+
+def keyword_lines(lowered, words):
+  
+  # yields where each line starting with one of the words is in 'lowered',
+  # the file's bytes in lower case, each word is searched for through the
+  # whole file without splitting up its lines
+  for word in words:
+    position = lowered.find(word)
+    while position >= 0:
+      start = max(lowered.rfind(b'\n', 0, position),
+                  lowered.rfind(b'\r', 0, position)) + 1
+      end = lowered.find(b'\n', position)
+      if end < 0:
+        end = len(lowered)
+      if b'\r' in lowered[position:end]:
+        end = lowered.find(b'\r', position, end)
+      if lowered[start:end].lstrip().startswith(word):
+        yield start, end
+      position = lowered.find(word, end)
+
+# ----------------------------------------------
+def scan_special(lowered):
+  
+  # scan for "INSERT" and "SECTION" directives, an included file without any
+  # is passed through to MPASM untouched, most don't have any of the words
+  for start, end in keyword_lines(lowered, special_words):
+    if lowered[start:end].split(None, 1)[0] in special_keywords:
+      return True
+  return False
+
+# ----------------------------------------------
+def include_once(lowered):
+  
+  # the marker for a file that is only ever included once
+  for start, end in keyword_lines(lowered, [once_keyword, ]):
+    if lowered[start:end].split(None, 1)[0] == once_keyword:
+      return True
+  return False
+
+# ----------------------------------------------
+def find_guard(lines, tokens):
+  
+  # returns the symbol of an '#ifndef X, #define X ... #endif' guard around
+  # the whole file, or None
+  keys = sorted(tokens)
+  if len(keys) < 3:
+    return None
+  first, second, last = tokens[keys[0]], tokens[keys[1]], tokens[keys[-1]]
+  if first[1] != '#ifndef' or second[1] != '#define' or \
+     last[1] != '#endif' or len(first[0]) < 2 or len(second[0]) < 2 or \
+     first[0][1].lower() != second[0][1].lower():
+    return None
+  depth = 0
+  for index in keys[2:-1]:
+    keyword = tokens[index][1]
+    if keyword in opening_conditionals:
+      depth += 1
+    elif keyword in ['#else', 'else', ] and depth == 0:
+      return None
+    elif keyword in ['#endif', 'endif', ]:
+      if depth == 0:
+        return None
+      depth -= 1
+  if depth:
+    return None
+  # nothing but comments outside of it
+  for line in lines[:keys[0]] + lines[keys[-1] + 1:]:
+    if line.strip()[:1] not in ['', ';', ]:
+      return None
+  return first[0][1]
+
+# ----------------------------------------------
+def summarize_bytes(data, lowered):
+  
+  # the same as summarize() for a file that is passed over, from its bytes;
+  # this can find a few more lines than splitting the file up would, which
+  # only means less is known for sure
+  import re, locale
+  
+  encoding = locale.getpreferredencoding(False)
+  assigns = set([name.decode(encoding, 'replace') for name in \
+                 re.findall(assigned_pattern, b'\n' + lowered)])
+  includes = []
+  radix = False
+  for start, end in keyword_lines(lowered, summary_words):
+    pieces = data[start:end].split(b';', 1)[0].decode(encoding, 'replace') \
+                                              .split()
+    keyword = pieces[0].lower()
+    if keyword in ['#define', '#undefine', ] and len(pieces) > 1:
+      assigns.add(pieces[1])
+    elif keyword == '#include' and len(pieces) > 1:
+      includes.append(pieces[1].strip('<>'))
+    elif keyword in ['variable', 'constant', ]:
+      for part in ' '.join(pieces[1:]).split(','):
+        name = part.split('=', 1)[0].strip()
+        if name:
+          assigns.add(name)
+    elif keyword == 'radix' or (keyword == 'list' and \
+                                'r=' in ''.join(pieces[1:]).lower()):
+      radix = True
+  return [sorted(assigns), includes, radix]
+
+# ----------------------------------------------
+def load_file(filename, need_lines=False, opened=None):
+  
+  import hashlib
+  
+  # returns a dict with the 'hash' of the file contents, the 'special' flag,
+  # the 'summary' of what it sets, the 'lines' of the file and their split up
+  # 'tokens', the last two are only there for files with the flag set unless
+  # 'need_lines' is given, whether it is included 'once' and the symbol of
+  # its include 'guard', only found in split up files, and records it in
+  # 'opened' for the manifest
+  
+  global cache_dir, cache_hits, cache_misses
+  
+  stat = os.stat(filename)
+  path = os.path.abspath(filename)
+  entry = memory_cache.get(path)
+  if entry and entry['size'] == stat.st_size and \
+     entry['mtime'] == stat.st_mtime_ns and \
+     (entry['lines'] is not None or not need_lines):
+    cache_hits += 1
+    record_opened(opened, filename, entry)
+    return entry
+  
+  cachefn = None
+  entry = None
+  if cache_dir:
+    import pickle
+    key = hashlib.sha1(path.encode()).hexdigest()
+    cachefn = os.path.join(cache_dir, key + '.tok')
+    try:
+      with open(cachefn, 'rb') as f:
+        entry = pickle.load(f)
+      if entry['version'] != cache_version:
+        entry = None
+    except Exception:
+      entry = None
+    if entry and entry['size'] == stat.st_size and \
+       entry['mtime'] == stat.st_mtime_ns and \
+       (entry['lines'] is not None or not need_lines):
+      cache_hits += 1
+      record_opened(opened, filename, entry)
+      memory_cache[path] = entry
+      return entry
+  
+  with open(filename, 'rb') as f:
+    data = f.read()
+  digest = hashlib.sha1(data).hexdigest()
+  
+  if entry and entry['hash'] == digest and \
+     (entry['lines'] is not None or not need_lines):
+    cache_hits += 1     # only touched, contents are the same
+  else:
+    cache_misses += 1
+    entry = split_file(data, digest, need_lines)
+  entry['size'] = stat.st_size
+  entry['mtime'] = stat.st_mtime_ns
+  
+  if cachefn:
+    import pickle
+    try:
+      os.makedirs(cache_dir, exist_ok=True)
+      tempfn = cachefn + '.' + str(os.getpid())
+      with open(tempfn, 'wb') as f:
+        pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+      os.replace(tempfn, cachefn)
+    except Exception as msg:
+      print('PRE WARNING: failed to write include cache, disabling it: ' + \
+            str(msg), file=sys.stderr)
+      cache_dir = None
+  record_opened(opened, filename, entry)
+  memory_cache[path] = entry
+  return entry
+
+# ----------------------------------------------
+def split_file(data, digest, need_lines=False):
+  
+  import locale
+  
+  # the entry for the contents of a file, without its size and time
+  lowered = data.lower()
+  special = scan_special(lowered)
+  once = include_once(lowered)
+  guard = None
+  if special or need_lines:
+    text = data.decode(locale.getpreferredencoding(False))
+    if '\r' in text:
+      text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if any(end in text for end in other_breaks):
+      lines = io.StringIO(text, newline=None).readlines()
+    else:
+      # the same lines, quicker
+      lines = text.splitlines(True)
+    tokens = split_lines(lines, text)
+    summary = summarize(tokens)
+    guard = find_guard(lines, tokens)
+  else:
+    # passed through untouched, so its lines are not split up
+    lines = None
+    tokens = None
+    summary = summarize_bytes(data, lowered)
+  return {'version': cache_version, 'hash': digest, 'special': special,
+          'lines': lines, 'tokens': tokens, 'summary': summary,
+          'once': once, 'guard': guard, }
+
+# ----------------------------------------------
+def record_opened(opened, filename, entry):
+  
+  if opened is not None:
+    opened[filename] = [entry['hash'], entry['size'], entry['mtime']]
+
+# -----------------------------------------------------------------------------
+# dependency manifest, written next to the interim file after a good run so the
+# next run can reuse the interim file when none of its inputs have changed
+
+manifest_version = 1
+# options that do not change what goes into the interim file
+nonoutput_options = ['cache-dir', 'no-cache', 'cache-stats', 'rebuild',
+                     'no-chain', 'pipe', 'no-result-cache',
+                     'result-cache-size', 'no-source-map', 'jobs',
+                     'stats', 'watch', 'no-replay', 'no-prefetch', ]
+
+def manifest_options():
+  
+  # the radix given to MPASM changes what #IF directives are pruned
+  return sorted([name, value] for name, value in options.items() \
+                if name not in nonoutput_options) + [['-r', mpasm_radix()], ]
+
+# ----------------------------------------------
+def program_id():
+  
+  # a change to this program invalidates all manifests
+  stat = os.stat(os.path.realpath(__file__))
+  return [stat.st_size, stat.st_mtime_ns]
+
+# ----------------------------------------------
+def write_manifest(opened_files):
+  
+  import json
+  
+  stat = os.stat(interim_file)
+  manifest = {'version': manifest_version, 'cwd': os.getcwd(),
+              'input': inputfilename, 'options': manifest_options(),
+              'program': program_id(),
+              'interim': [stat.st_size, stat.st_mtime_ns],
+              'files': opened_files, }
+  try:
+    tempfn = manifest_file + '.' + str(os.getpid())
+    with open(tempfn, 'w') as f:
+      f.write(json.dumps(manifest))
+    os.replace(tempfn, manifest_file)
+  except Exception as msg:
+    print('PRE WARNING: failed to write manifest file: ' + str(msg), \
+          file=sys.stderr)
+
+# ----------------------------------------------
+def manifest_valid():
+  
+  import json, hashlib
+  
+  try:
+    with open(manifest_file, 'r') as f:
+      manifest = json.load(f)
+    stat = os.stat(interim_file)
+  except Exception:
+    return False
+  
+  if manifest.get('version') != manifest_version or \
+     manifest['cwd'] != os.getcwd() or \
+     manifest['input'] != inputfilename or \
+     manifest['options'] != manifest_options() or \
+     manifest['program'] != program_id() or \
+     manifest['interim'] != [stat.st_size, stat.st_mtime_ns]:
+    return False
+  
+  for filename, state in manifest['files'].items():
+    if state is None:
+      # failed to open last time, so it's only good if it's still not there
+      if os.path.exists(filename):
+        return False
+      continue
+    try:
+      stat = os.stat(filename)
+    except Exception:
+      return False
+    if [stat.st_size, stat.st_mtime_ns] == state[1:]:
+      continue
+    try:
+      with open(filename, 'rb') as f:
+        if hashlib.sha1(f.read()).hexdigest() != state[0]:
+          return False
+    except Exception:
+      return False
+  return True
+
+# ----------------------------------------------
+def lock_interim():
+  
+  import hashlib
+  
+  # builds of the same interim file take turns, so one run by the IDE while
+  # --watch is building waits for it and then finds its result, the lock is
+  # held until the file returned is closed; the lock file is kept in the
+  # cache directory, or the temporary one, named for the interim file, so
+  # nothing is left in the source tree
+  try:
+    import fcntl
+  except ImportError:
+    return None
+  # where tempfile would put it, without the time importing it takes
+  directory = cache_dir or os.environ.get('TMPDIR') or '/tmp'
+  name = hashlib.sha1(os.path.abspath(interim_file).encode()).hexdigest()
+  try:
+    os.makedirs(directory, exist_ok=True)
+    lock = open(os.path.join(directory, name + '.lock'), 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+  except OSError:
+    return None
+  return lock
+
+# -----------------------------------------------------------------------------
+# assembler result cache, the files written by MPASM and its exit code are kept
+# in the cache directory keyed by a hash of the interim file, the options passed
+# to MPASM and the MPASM binary, so assembling the same thing again is a copy
+
+result_cache_version = 3
+
+def mpasm_options():
+  
+  # the defines given are passed on too, for what is left to the assembler
+  return list(passed_options) + \
+         ['-d' + name + ('' if value is None else '=' + value) \
+          for name, value in option_defines().items()]
+
+# ----------------------------------------------
+def option_defines():
+  
+  # '--define=NAME,NAME=value' as a dict
+  defines = {}
+  if options.get('define', True) is True:
+    return defines
+  for define in options['define'].split(','):
+    name, sep, value = define.strip().partition('=')
+    if name:
+      defines[name] = value if sep else None
+  return defines
+
+# ----------------------------------------------
+def mpasm_radix():
+  
+  # the default radix given to MPASM with '-r', hex if not given
+  radix = 'hex'
+  for entry in passed_options:
+    if entry[1:2].lower() == 'r':
+      radix = entry[2:].lower()
+  return radix
+
+# ----------------------------------------------
+def result_outputs(mpasm_args, letters='elox',
+                   exts=['.HEX', '.O', '.LST', '.ERR', '.COD', '.XRF', ]):
+  
+  # the files MPASM may write, next to the source file by default or where the
+  # -e, -l, -o and -x options say
+  base = os.path.splitext(interim_file)[0]
+  outputs = []
+  for ext in exts:
+    outputs.append(base + ext)
+    outputs.append(base + ext.lower())
+  for entry in mpasm_args:
+    if entry[1:2].lower() in letters and len(entry) > 2:
+      path = entry[2:].lstrip('=').strip('"')
+      if path not in ['', '+', '-', ] and path not in outputs:
+        outputs.append(path)
+  return outputs
+
+# ----------------------------------------------
+def output_states(outputs):
+  
+  states = {}
+  for path in outputs:
+    try:
+      stat = os.stat(path)
+      states[path] = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    except OSError:
+      states[path] = None
+  return states
+
+# ----------------------------------------------
+def result_key(mpasm_args):
+  
+  import hashlib
+  
+  # the files left for MPASM to include are part of it, with no key when
+  # one of them is not found
+  includes = {}
+  try:
+    stat = os.stat(mpasm_prog)
+    with open(interim_file, 'rb') as f:
+      data = f.read()
+    if not passed_includes(data, interim_file, includes):
+      return None
+  except Exception:
+    return None
+  digest = hashlib.sha1()
+  for part in [str(result_cache_version), os.getcwd(), interim_file,
+               os.path.realpath(mpasm_prog), str(stat.st_size),
+               str(stat.st_mtime_ns), ] + mpasm_args + \
+              [repr(item) for item in sorted(includes.items())]:
+    digest.update(part.encode() + b'\0')
+  digest.update(data)
+  return digest.hexdigest()
+
+# ----------------------------------------------
+def passed_includes(data, including, found):
+  
+  import locale
+  
+  # adds the size and mtime of each file the bytes 'data' include to 'found'
+  # by absolute path, and of the ones those include, looked for where MPASM
+  # looks, returns False when one is not found; includes under conditionals
+  # are counted too, which only means a result is kept for less
+  encoding = locale.getpreferredencoding(False)
+  directories = ['', os.path.dirname(including),
+                 os.path.dirname(os.path.realpath(mpasm_prog)), ]
+  for start, end in keyword_lines(data.lower(), [b'#include', b'include', ]):
+    pieces = data[start:end].split(b';', 1)[0].decode(encoding, 'replace') \
+                                              .split(None, 1)
+    if len(pieces) < 2 or pieces[0].lower() not in ['#include', 'include', ]:
+      continue
+    name = pieces[1].strip()
+    if name[:1] in ['"', '<', ]:
+      name = name[1:].split('>' if name[:1] == '<' else '"', 1)[0]
+    else:
+      name = name.split()[0]
+    for directory in directories:
+      path = os.path.abspath(os.path.join(directory, name))
+      if os.path.isfile(path):
+        break
+    else:
+      return False
+    if path in found:
+      continue
+    stat = os.stat(path)
+    found[path] = [stat.st_size, stat.st_mtime_ns]
+    with open(path, 'rb') as f:
+      if not passed_includes(f.read(), path, found):
+        return False
+  return True
+
+# ----------------------------------------------
+def restore_result(key):
+  
+  import json, shutil
+  
+  resultdir = os.path.join(cache_dir, 'results', key)
+  try:
+    with open(os.path.join(resultdir, 'result.json'), 'r') as f:
+      result = json.load(f)
+    for path, stored in result['outputs']:
+      shutil.copyfile(os.path.join(resultdir, stored), path)
+    os.utime(os.path.join(resultdir, 'result.json'))   # mark as recently used
+  except Exception:
+    return None
+  return result['exit']
+
+# ----------------------------------------------
+def store_result(key, before, exitcode):
+  
+  import json, shutil
+  
+  after = output_states(before)
+  written = [path for path in before if after[path] not in [None, before[path]]]
+  if not written:
+    return    # MPASM did not run properly, don't keep that around
+  
+  resultsdir = os.path.join(cache_dir, 'results')
+  tempdir = os.path.join(resultsdir, key + '.' + str(os.getpid()))
+  try:
+    os.makedirs(tempdir)
+    stored = []
+    for index, path in enumerate(written):
+      shutil.copyfile(path, os.path.join(tempdir, str(index)))
+      stored.append([path, str(index)])
+    with open(os.path.join(tempdir, 'result.json'), 'w') as f:
+      f.write(json.dumps({'exit': exitcode, 'outputs': stored, }))
+    os.rename(tempdir, os.path.join(resultsdir, key))
+  except Exception:
+    shutil.rmtree(tempdir, ignore_errors=True)
+    return
+  trim_results(resultsdir)
+
+# ----------------------------------------------
+def trim_results(resultsdir):
+  
+  import shutil
+  
+  # drop the least recently used results until the store fits
+  results = []
+  total = 0
+  for name in os.listdir(resultsdir):
+    resultdir = os.path.join(resultsdir, name)
+    try:
+      used = os.stat(os.path.join(resultdir, 'result.json')).st_mtime
+      size = 0
+      for name2 in os.listdir(resultdir):
+        size += os.path.getsize(os.path.join(resultdir, name2))
+    except OSError:
+      continue    # being written or removed by another run
+    results.append((used, size, resultdir))
+    total += size
+  
+  results.sort()
+  for used, size, resultdir in results:
+    if total <= result_cache_size:
+      break
+    shutil.rmtree(resultdir, ignore_errors=True)
+    total -= size
+
+# -----------------------------------------------------------------------------
+# with --pipe the interim file is a named pipe, MPASM is started first and reads
+# the interim file while it is being written
+
+def mpasm_command(mpasm_args):
+  
+  return [mpasm_prog] + mpasm_args + [interim_file]
+
+# ----------------------------------------------
+def start_pipe(mpasm_args):
+  
+  import subprocess
+  
+  # returns MPASM running on the pipe and the pipe opened for writing, the
+  # file is None if MPASM quit without opening it
+  if os.path.lexists(interim_file):
+    os.remove(interim_file)
+  os.mkfifo(interim_file)
+  proc = subprocess.Popen(mpasm_command(mpasm_args))
+  while True:
+    try:
+      fd = os.open(interim_file, os.O_WRONLY | os.O_NONBLOCK)
+      break
+    except OSError as msg:
+      if msg.errno != errno.ENXIO:
+        raise
+    # not open for reading yet, this waits on MPASM so it notices it quitting
+    try:
+      proc.wait(timeout=0.01)
+      return proc, None
+    except subprocess.TimeoutExpired:
+      pass
+  os.set_blocking(fd, True)
+  return proc, os.fdopen(fd, 'w')
+
+# ----------------------------------------------
+def stop_pipe(proc):
+  
+  proc.kill()
+  proc.wait()
+  remove_fifo()
+
+# ----------------------------------------------
+def remove_fifo():
+  
+  try:
+    if stat.S_ISFIFO(os.lstat(interim_file).st_mode):
+      os.remove(interim_file)
+  except OSError:
+    pass
+
+# -----------------------------------------------------------------------------
+# source map, kept while writing the interim file, from ranges of interim file
+# lines back to the line in the original file they came from, used to point
+# the assembler's error and listing files at the original files
+
+source_map_version = 1
+diagnostic_pattern = r'^((?:Error|Warning|Message)\[\d+\]\s+)(.+?)\s+(\d+)' + \
+                     r'\s*:\s?(.*?)\s*$'
+listing_pattern = r'(?<!\S)(\d{5})(?: |$)'
+
+class InterimWriter:
+  
+  # the interim file, counting the lines written, with the source map entries
+  # of [first interim line, file number, line, fixed, note], where a 'fixed'
+  # entry maps all its lines to the one line, others count up from it, and
+  # with notes off the comments that only annotate what it found are left out
+  
+  def __init__(self, file):
+    self.file = file
+    self.notes = True
+    self.line = 1
+    self.files = []
+    self.file_numbers = {}
+    self.entries = []
+  
+  def write(self, text):
+    self.line += text.count('\n')
+    self.file.write(text)
+  
+  def note(self, text):
+    if self.notes:
+      self.line += text.count('\n')
+      self.file.write(text)
+  
+  def close(self):
+    self.file.close()
+  
+  def write_marked(self, filename, pieces):
+    # writes the [line, fixed, note, text] pieces in one go, marking the line
+    # of the file each came from
+    for line, fixed, note, text in pieces:
+      self.mark(filename, line, fixed, note)
+      self.line += text.count('\n')
+    self.file.write(''.join([piece[3] for piece in pieces]))
+  
+  def drop_lines(self, ranges):
+    # the lines in the sorted [first, end) ranges were taken out of the text
+    # written, the map entries after them move up
+    ends = [end for first, end in ranges]
+    dropped = [0, ]
+    for first, end in ranges:
+      dropped.append(dropped[-1] + end - first)
+    entries = []
+    for index, entry in enumerate(self.entries):
+      if index + 1 < len(self.entries):
+        stop = self.entries[index + 1][0]
+      else:
+        stop = self.line
+      position = entry[0]
+      while position < stop:
+        at = bisect.bisect_right(ends, position)
+        if at < len(ranges) and ranges[at][0] <= position:
+          position = ranges[at][1]
+          continue
+        line = entry[2] if entry[3] else entry[2] + position - entry[0]
+        entries.append([position - dropped[at], entry[1], line, ] + entry[3:])
+        position = ranges[at][0] if at < len(ranges) else stop
+    self.entries = entries
+    self.line -= dropped[-1]
+  
+  def number(self, filename):
+    if filename not in self.file_numbers:
+      self.file_numbers[filename] = len(self.files)
+      self.files.append(os.path.abspath(filename))
+    return self.file_numbers[filename]
+  
+  def mark(self, filename, line, fixed=False, note=None):
+    # the lines written from here on come from this line of the file
+    number = self.number(filename)
+    entries = self.entries
+    if entries:
+      last = entries[-1]
+      if last[0] == self.line:
+        entries.pop()     # nothing was written for that one
+      else:
+        if last[3] and self.line - last[0] == 1:
+          last[3] = False     # a single line is the same either way
+        if not fixed and not last[3] and last[1] == number and \
+           last[4] == note and self.line - last[0] == line - last[2]:
+          return          # carries on from the last one
+    entries.append([self.line, number, line, fixed, note])
+
+# ----------------------------------------------
+def write_source_map(writer):
+  
+  import json
+  
+  try:
+    tempfn = source_map_file + '.' + str(os.getpid())
+    with open(tempfn, 'w') as f:
+      f.write(json.dumps({'version': source_map_version,
+                          'files': writer.files, 'entries': writer.entries, },
+                         separators=(',', ':')))
+    os.replace(tempfn, source_map_file)
+  except Exception as msg:
+    print('PRE WARNING: failed to write source map: ' + str(msg), \
+          file=sys.stderr)
+
+# ----------------------------------------------
+def load_source_map():
+  
+  import json
+  
+  try:
+    with open(source_map_file, 'r') as f:
+      source_map = json.load(f)
+  except Exception:
+    return None
+  if source_map.get('version') != source_map_version:
+    return None
+  return source_map
+
+# ----------------------------------------------
+def map_line(source_map, line):
+  
+  # returns the original file, line and note for a line of the interim file
+  entries = source_map['entries']
+  if 'starts' not in source_map:
+    source_map['starts'] = [entry[0] for entry in entries]
+  index = bisect.bisect_right(source_map['starts'], line) - 1
+  if index < 0:
+    return None
+  start, number, original, fixed, note = entries[index]
+  if not fixed:
+    original += line - start
+  return source_map['files'][number], original, note
+
+# ----------------------------------------------
+def rewrite_diagnostic(source_map, text):
+  
+  import re
+  
+  # returns the error line pointed at the original file, or None if it isn't
+  # one about the interim file
+  match = re.match(diagnostic_pattern, text)
+  if not match:
+    return None
+  path = match.group(2).replace('\\', '/')
+  if os.path.basename(path).lower() != os.path.basename(interim_file).lower():
+    return None
+  where = map_line(source_map, int(match.group(3)))
+  if where is None:
+    return None
+  filename, line, note = where
+  text = match.group(1) + filename + ' ' + str(line) + ' : ' + match.group(4)
+  if note:
+    text += ' (' + note + ')'
+  return text
+
+# ----------------------------------------------
+def rewrite_listing_line(source_map, text, interim_lines):
+  
+  import re
+  
+  # returns where a listing line of the interim file came from, checked
+  # against the interim file since included files are listed too
+  for match in re.finditer(listing_pattern, text):
+    line = int(match.group(1))
+    if line < 1 or line > len(interim_lines):
+      return None
+    if ' '.join(text[match.end():].split()) != \
+       ' '.join(interim_lines[line - 1].split()):
+      return None
+    return map_line(source_map, line)
+  return None
+
+# ----------------------------------------------
+def rewrite_outputs(source_map, mpasm_args):
+  
+  # points the errors in the .ERR and .LST files at the original files
+  interim_lines = None
+  for path in result_outputs(mpasm_args, 'el', ['.ERR', '.LST', ]):
+    try:
+      with open(path, 'r', encoding='latin-1', newline='') as f:
+        lines = f.read().splitlines(True)
+    except OSError:
+      continue
+    changed = False
+    pending = []    # listing errors waiting for the line they are about
+    for index, line in enumerate(lines):
+      text = line.rstrip('\r\n')
+      ending = line[len(text):]
+      newtext = rewrite_diagnostic(source_map, text)
+      if newtext is not None:
+        lines[index] = newtext + ending
+        changed = True
+        continue
+      if text[:6] in ['Error[', 'Warnin', 'Messag', ]:
+        pending.append(index)
+        continue
+      if pending:
+        if interim_lines is None:
+          try:
+            with open(interim_file, 'r') as f:
+              interim_lines = f.readlines()
+          except OSError:
+            interim_lines = []
+        where = rewrite_listing_line(source_map, text, interim_lines)
+        if where is not None:
+          filename, line2, note = where
+          for index2 in pending:
+            text2 = lines[index2].rstrip('\r\n')
+            lines[index2] = text2 + ' <' + filename + ' ' + str(line2) + \
+                            ('' if not note else ', ' + note) + '>' + \
+                            lines[index2][len(text2):]
+          changed = True
+        pending = []
+    if changed:
+      try:
+        with open(path, 'w', encoding='latin-1', newline='') as f:
+          f.write(''.join(lines))
+      except OSError as msg:
+        print('PRE WARNING: failed to rewrite ' + path + ': ' + str(msg), \
+              file=sys.stderr)
+
+# -----------------------------------------------------------------------------
+# batch mode, with more than one top level file each one is run through a copy
+# of this program with its own interim file, up to 'jobs' at a time, sharing
+# the include cache, and their output is shown in the order they were given
+
+def batch_interim_files():
+  
+  names = []
+  for filename in inputfilenames:
+    name = os.path.basename(filename.strip('"')).split('.')[0]
+    name = '_pre_processed_' + name
+    if name in names:
+      name += '_' + str(len(names))
+    names.append(name)
+  return [name + '.asm' for name in names]
+
+# ----------------------------------------------
+def run_batch():
+  
+  common = ['--' + name + ('' if value is True else '=' + value) \
+            for name, value in options.items() \
+            if name not in ['jobs', 'interim', ]]
+  common += passed_options
+  commands = []
+  for filename, interim in zip(inputfilenames, batch_interim_files()):
+    commands.append([sys.executable, script_file, filename,
+                     '--interim=' + interim, ] + common)
+  return run_commands(inputfilenames, commands, jobs)
+
+# ----------------------------------------------
+def run_commands(names, commands, workers):
+  
+  import concurrent.futures, subprocess
+  
+  # runs the commands, up to 'workers' at a time, and returns the exit code
+  # of the first to fail
+  def run(command):
+    return subprocess.run(command, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+  
+  exitcode = 0
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) \
+       as pool:
+    results = [pool.submit(run, command) for command in commands]
+    # waiting on each in turn keeps the output in order
+    for filename, result in zip(names, results):
+      result = result.result()
+      print('PRE INFO: ' + filename + ':', file=sys.stderr)
+      sys.stdout.flush()
+      sys.stdout.buffer.write(result.stdout)
+      sys.stdout.flush()
+      sys.stderr.flush()
+      sys.stderr.buffer.write(result.stderr)
+      sys.stderr.flush()
+      if result.returncode != 0:
+        print('PRE ERROR: ' + filename + ' failed: ' + \
+              str(result.returncode), file=sys.stderr)
+        if exitcode == 0:
+          exitcode = result.returncode
+  return exitcode
+
+# -----------------------------------------------------------------------------
+# matrix mode, with '--matrix=file' the top level file is built once for each
+# set of defines in the file, one after another in this process, so the files
+# read and the include expansions that don't depend on the defines are shared,
+# then the variants are assembled up to 'jobs' at a time
+
+def read_matrix(filename):
+  
+  # a line for each variant, its name and the defines, as NAME or NAME=value
+  variants = []
+  try:
+    with open(filename, 'r') as f:
+      for line in f:
+        pieces = line.split(';', 1)[0].split()
+        if not pieces:
+          continue
+        if not all(c.isalnum() or c in '_-' for c in pieces[0]) or \
+           pieces[0] in [name for name, defines in variants]:
+          print('PRE-PREPROCESSOR ERROR: bad variant name in matrix ' + \
+                'file: ' + pieces[0], file=sys.stderr)
+          sys.exit(1)
+        variants.append([pieces[0], pieces[1:]])
+  except OSError as msg:
+    print('PRE-PREPROCESSOR ERROR: failed to read matrix file, error: ' + \
+          str(msg), file=sys.stderr)
+    sys.exit(1)
+  return variants
+
+# ----------------------------------------------
+def run_matrix():
+  
+  import hashlib
+  
+  global errfile
+  
+  variants = read_matrix(options['matrix'])
+  chained = mpasm_prog and 'no-chain' not in options
+  workers = jobs    # each variant's arguments set these again
+  common = ['--' + name + ('' if value is True else '=' + value) \
+            for name, value in options.items() \
+            if name not in ['jobs', 'interim', 'matrix', 'define',
+                            'no-chain', ]]
+  if 'interim-dir' not in options:
+    common.append('--interim-dir=.')    # so the error files are theirs too
+  common += passed_options
+  base = [define for define in options.get('define', '').split(',') if define]
+  
+  exitcode = 0
+  digests = {}      # by hash of the interim file, the variants that wrote it
+  commands = []
+  for name, defines in variants:
+    argv = [inputfilename, '--interim=_pre_processed_' + name + '.asm', ] + \
+           common
+    if base + defines:
+      argv.append('--define=' + ','.join(base + defines))
+    print('PRE INFO: variant ' + name + ':', file=sys.stderr)
+    
+    # built here, as by the daemon, the assembler is left for later
+    try:
+      parse_arguments(argv + ['--no-chain', ])
+      build()
+      result = 0
+    except SystemExit as msg:
+      result = msg.code if isinstance(msg.code, int) else 1
+    if errfile:
+      errfile.close()
+      errfile = None
+    if result != 0:
+      print('PRE ERROR: variant ' + name + ' failed: ' + str(result), \
+            file=sys.stderr)
+      exitcode = exitcode or result
+      continue
+    
+    with open(interim_file, 'rb') as f:
+      digest = hashlib.sha1(f.read()).hexdigest()
+    digests.setdefault(digest, []).append(name)
+    commands.append([name, [sys.executable, script_file, ] + \
+                           argv])
+  
+  for names in digests.values():
+    if len(names) > 1:
+      print('PRE INFO: matrix: identical interim files: ' + ', '.join(names), \
+            file=sys.stderr)
+  print('PRE INFO: matrix: ' + str(len(variants)) + ' variants, ' + \
+        str(len(digests)) + ' different interim files', file=sys.stderr)
+  
+  if chained and commands:
+    # each finds its interim file up to date and runs the assembler
+    result = run_commands([name for name, command in commands],
+                          [command for name, command in commands], workers)
+    exitcode = exitcode or result
+  return exitcode
+
+# -----------------------------------------------------------------------------
+# #IF expressions, worked out the way MPASM would, but only when every symbol
+# in them has a value known for sure at that point, so the branch that is not
+# taken can be left out of the interim file
+
+class Unresolved(Exception):
+  pass
+
+token_pattern = r"\s*([A-Za-z]'[^']*'|'[^']*'|[A-Za-z_?][\w?]*|\.\d+|\d\w*|" + \
+                r"<<|>>|<=|>=|==|!=|&&|\|\||\S)"
+radix_bases = {'hex': 16, 'dec': 10, 'oct': 8, }
+number_bases = {'h': 16, 'd': 10, 'o': 8, 'b': 2, }
+# lowest to highest precedence
+binary_operators = [['||', ], ['&&', ], ['|', ], ['^', ], ['&', ],
+                    ['==', '!=', ], ['<', '<=', '>', '>=', ], ['<<', '>>', ],
+                    ['+', '-', ], ['*', '/', '%', ], ]
+unary_operators = ['-', '+', '~', '!', 'low', 'high', 'upper', ]
+
+def evaluate(pre, text, depth=0):
+  
+  # returns the value of the expression, raises Unresolved if it can't be
+  # known here
+  if text.isalnum():
+    # just a number or a symbol, the most common
+    if text[:1].isdigit():
+      if pre.recording:
+        pre.seen('radix', None)
+      return number_value(text, pre.radix)
+    return symbol_value(pre, text, depth)
+  import re
+  tokens = re.findall(token_pattern, text)
+  if not tokens or ''.join(tokens) != ''.join(text.split()):
+    raise Unresolved()
+  value, position = parse_binary(pre, tokens, 0, 0, depth)
+  if position != len(tokens):
+    raise Unresolved()
+  return value
+
+# ----------------------------------------------
+def parse_binary(pre, tokens, position, level, depth):
+  
+  if level == len(binary_operators):
+    return parse_unary(pre, tokens, position, depth)
+  value, position = parse_binary(pre, tokens, position, level + 1, depth)
+  while position < len(tokens) and tokens[position] in binary_operators[level]:
+    operator = tokens[position]
+    right, position = parse_binary(pre, tokens, position + 1, level + 1, depth)
+    value = apply_binary(operator, value, right)
+  return value, position
+
+# ----------------------------------------------
+def parse_unary(pre, tokens, position, depth):
+  
+  if position >= len(tokens):
+    raise Unresolved()
+  token = tokens[position]
+  lowered = token.lower()
+  if lowered in unary_operators:
+    value, position = parse_unary(pre, tokens, position + 1, depth)
+    return apply_unary(lowered, value), position
+  if token == '(':
+    value, position = parse_binary(pre, tokens, position + 1, 0, depth)
+    if position >= len(tokens) or tokens[position] != ')':
+      raise Unresolved()
+    return value, position + 1
+  if lowered == 'defined':
+    # defined(name) or defined name, only known when it is
+    if tokens[position + 1:position + 2] == ['(', ] and \
+       tokens[position + 3:position + 4] == [')', ]:
+      name = tokens[position + 2]
+      position += 4
+    elif position + 1 < len(tokens):
+      name = tokens[position + 1]
+      position += 2
+    else:
+      raise Unresolved()
+    # the same as #IFDEF, only a name from #DEFINE is known
+    symbol_value(pre, name, None)
+    if pre.symbols[name.lower()][1] != 'text':
+      raise Unresolved()
+    return 1, position
+  if token[:1].isdigit() or token[:1] in ".'" or token[1:2] == "'":
+    if pre.recording:
+      pre.seen('radix', None)
+    return number_value(token, pre.radix), position + 1
+  if token[:1].isalpha() or token[:1] in '_?':
+    return symbol_value(pre, token, depth), position + 1
+  raise Unresolved()
+
+# ----------------------------------------------
+def number_value(token, radix):
+  
+  # H'1F', D'10', O'17', B'101', A'c', 'c', 0x1F, .10, or digits in the radix
+  if token[1:2] == "'" and token[-1:] == "'" and len(token) > 3:
+    kind = token[0].lower()
+    digits = token[2:-1]
+    if kind == 'a' and len(digits) == 1:
+      return ord(digits)
+    if kind not in number_bases:
+      raise Unresolved()
+    base = number_bases[kind]
+  elif token[:1] == "'" and len(token) == 3 and token[-1:] == "'":
+    return ord(token[1])
+  elif token[:2].lower() == '0x':
+    digits = token[2:]
+    base = 16
+  elif token[:1] == '.':
+    digits = token[1:]
+    base = 10
+  elif radix is None:
+    # the same in any radix
+    if len(token) == 1 and token in '01234567':
+      return int(token)
+    raise Unresolved()
+  else:
+    digits = token
+    base = radix_bases[radix]
+  if not digits or digits.lower().strip('0123456789abcdef'[:base]):
+    raise Unresolved()
+  return int(digits, base)
+
+# ----------------------------------------------
+def symbol_value(pre, name, depth):
+  
+  # a 'depth' of None only checks the symbol is known
+  if pre.recording:
+    pre.seen('symbol', name.lower())
+  entry = pre.symbols.get(name.lower())
+  if entry is None or entry[0] != name:
+    raise Unresolved()
+  if depth is None:
+    return None
+  if entry[1] == 'number':
+    return entry[2]
+  # text of a #DEFINE, worked out where it is used like MPASM does
+  if entry[2] is None or depth > 16:
+    raise Unresolved()
+  return evaluate(pre, entry[2], depth + 1)
+
+# ----------------------------------------------
+def wrap(value):
+  
+  # MPASM works in 32 bit signed numbers
+  return ((value + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+# ----------------------------------------------
+def apply_unary(operator, value):
+  
+  if operator == '-':
+    return wrap(-value)
+  if operator == '+':
+    return value
+  if operator == '~':
+    return wrap(~value)
+  if operator == '!':
+    return int(value == 0)
+  if operator == 'low':
+    return value & 0xFF
+  if operator == 'high':
+    return (value >> 8) & 0xFF
+  return (value >> 16) & 0xFF     # upper
+
+# ----------------------------------------------
+def apply_binary(operator, left, right):
+  
+  if operator in ['/', '%', ]:
+    if right == 0:
+      raise Unresolved()
+    quotient = abs(left) // abs(right)
+    if (left < 0) != (right < 0):
+      quotient = -quotient
+    if operator == '/':
+      return wrap(quotient)
+    return wrap(left - right * quotient)
+  if operator in ['<<', '>>', ]:
+    if right < 0 or right > 31:
+      raise Unresolved()
+    if operator == '<<':
+      return wrap(left << right)
+    return left >> right
+  if operator == '+':
+    return wrap(left + right)
+  if operator == '-':
+    return wrap(left - right)
+  if operator == '*':
+    return wrap(left * right)
+  if operator == '&':
+    return left & right
+  if operator == '|':
+    return left | right
+  if operator == '^':
+    return left ^ right
+  if operator == '&&':
+    return int(left != 0 and right != 0)
+  if operator == '||':
+    return int(left != 0 or right != 0)
+  return int({'==': left == right, '!=': left != right, '<': left < right,
+              '<=': left <= right, '>': left > right,
+              '>=': left >= right, }[operator])
+
+# -----------------------------------------------------------------------------
+
+class ParseState:
+  
+  # what is being parsed in one file, passed to the directive handlers
+  
+  def __init__(self, pre, lines, tokens, outfile, filename):
+    self.pre = pre      # the Preprocessor this is for
+    self.lines = lines
+    self.tokens = tokens
+    self.outfile = outfile
+    self.filename = filename
+    self.count = 0
+    self.splices = {'#splicebefore': [], '#splicebetween': [],
+                    '#spliceafter': [], '#spliceempty': [], }
+    self.keys = None    # the lines in tokens in order, when needed
+
+# ----------------------------------------------
+def parse_file(pre, lines, tokens, outfile, filename):
+  
+  # only the lines in 'tokens' can be directives, the lines between them are
+  # copied straight through in one write, and counted in the source map when
+  # the next directive comes up
+  state = ParseState(pre, lines, tokens, outfile, filename)
+  pre.frames.append(state)
+  if pre.prefetcher is not None:
+    # a file with one include to read waits for it either way, so no
+    # thread is started for that, the files read ahead are scanned in turn
+    pre.prefetcher.scan(tokens, 2)
+  if pre.stats is not None:
+    started = pre.stats.clock()
+    pre.stats.nested.append(0.0)
+  keys = [index for index, token in tokens.items() if token[1] in directives]
+  write = outfile.file.write
+  strip = pre.verbosity == 'bare'
+  end = len(lines)
+  outfile.mark(filename, 1)
+  copied = 0
+  count = 0
+  position = 0
+  while True:
+    position = bisect.bisect_left(keys, count, position)
+    stop = keys[position] if position < len(keys) else end
+    if not strip:
+      if stop > count:
+        write(''.join(lines[count:stop]))
+    else:
+      for count in range(count, stop):
+        if not lines[count].split(';', 1)[0].strip():
+          # blank or only a comment, left out, the map skips over it
+          outfile.line += count - copied
+          copied = count + 1
+          outfile.mark(filename, count + 2)
+        else:
+          write(lines[count])
+    count = stop
+    if count >= end:
+      break
+    
+    pieces, keyword = tokens[count]
+    handler = directives[keyword]
+    if keyword in argument_directives and len(pieces) < 2:
+      print('PRE-PREPROCESSOR: not enough arguments in ' + filename + \
+            ' at line ' + str(count + 1), file=sys.stderr)
+      print('- line: ' + lines[count], file=sys.stderr)
+      pre.errfile.write('PRE-PREPROCESSOR: not enough arguments in ' + \
+                        filename + ' at line ' + str(count + 1) + '\n')
+      pre.errfile.write('- line: ' + lines[count] + '\n')
+      sys.exit(1)
+    
+    outfile.line += count - copied
+    outfile.mark(filename, count + 1, fixed=True)
+    state.count = count
+    if pre.stats is None:
+      handler(state, lines[count], pieces, keyword)
+    else:
+      pre.stats.directive(handler, state, lines[count], pieces, keyword)
+    if pre.analyzers:
+      for analyzer in pre.analyzers:
+        analyzer.directive(state, keyword, pieces, count)
+    count = state.count + 1
+    copied = count
+    outfile.mark(filename, count + 1)
+  
+  outfile.line += end - copied
+  if end > copied and lines[-1][-1:] != '\n':
+    outfile.line -= 1
+  pre.frames.pop()
+  if pre.stats is not None:
+    pre.stats.parsed(filename, end, pre.stats.clock() - started)
+
+# ----------------------------------------------
+def read_block(state, endkeyword, name, opening=None):
+  
+  # returns the lines up to the closing directive, leaving the count on it,
+  # blocks started with the 'opening' directive can be nested in it
+  lines = state.lines
+  tokens = state.tokens
+  block = []
+  count = state.count
+  depth = 0
+  while True:
+    count += 1
+    if count >= len(lines):
+      state.outfile.write('; PRE-PREPROCESSOR ERROR: did not find end of ' + \
+                          name + ' directive in file: ' + state.filename + '\n')
+      print('PRE-PREPROCESSOR ERROR: did not find end of ' + name + \
+            ' directive in file: ' + state.filename, file=sys.stderr)
+      sys.exit(1)
+    if count in tokens and tokens[count][1] == opening:
+      depth += 1
+    elif count in tokens and tokens[count][1] == endkeyword:
+      if depth == 0:
+        state.count = count
+        return block
+      depth -= 1
+    block.append(lines[count])
+
+# ----------------------------------------------
+def do_endif(state, line, pieces, keyword):
+  
+  pre = state.pre
+  if len(pre.ifstack) == 0:
+    print('unmatched ENDIF directive in ' + state.filename, file=sys.stderr)
+    pre.errfile.write('unmatched ENDIF directive in file ' + \
+                      state.filename + ' at line ' + str(state.count) + '\n')
+    sys.exit(1)
+  pre.ifstack.pop()
+  if pre.ifprune.pop():
+    state.outfile.write('; PRE-PREPROCESSOR, pruned: ' + line.strip() + '\n')
+  else:
+    state.outfile.write(line)
+
+# ----------------------------------------------
+def do_else(state, line, pieces, keyword):
+  
+  pre = state.pre
+  if len(pre.ifstack) == 0:
+    print('unmatched ELSE directive in ' + state.filename, file=sys.stderr)
+    pre.errfile.write('unmatched ELSE directive in file ' + \
+                      state.filename + ' at line ' + str(state.count) + '\n')
+    sys.exit(1)
+  if pre.ifprune[-1]:
+    # the branch taken ends here, skip the other one
+    state.count = find_branch_end(state, False)
+    pre.ifstack.pop()
+    pre.ifprune.pop()
+    state.outfile.write('; PRE-PREPROCESSOR, pruned: ' + line.strip() + \
+                        ' to line ' + str(state.count + 1) + '\n')
+    return
+  index = len(pre.ifstack) - 1
+  if pre.ifstack[index] is True:
+    pre.ifstack[index] = False
+  elif pre.ifstack[index] is False:
+    pre.ifstack[index] = True
+  state.outfile.write(line)
+
+# ----------------------------------------------
+def do_if(state, line, pieces, keyword):
+  
+  pre = state.pre
+  if pre.prune and not pre.bodies:
+    try:
+      taken = evaluate(pre, ' '.join(pieces[1:])) != 0
+      if prune_conditional(state, line, taken):
+        return
+    except Unresolved:
+      pass
+  pre.ifstack.append(None)
+  pre.ifprune.append(False)
+  state.outfile.write(line)
+
+# ----------------------------------------------
+def do_ifdef(state, line, pieces, keyword):
+  
+  pre = state.pre
+  if pre.prune and not pre.bodies:
+    try:
+      # only for a name from #DEFINE, one set with 'set', 'equ' or '=' is
+      # left for the assembler
+      symbol_value(pre, pieces[1], None)
+      if pre.symbols[pieces[1].lower()][1] == 'text' and \
+         prune_conditional(state, line, keyword == '#ifdef'):
+        return
+    except Unresolved:
+      pass
+  if pre.recording:
+    pre.seen('define', pieces[1].lower())
+  defined = pieces[1].lower() in pre.defines
+  pre.ifstack.append(defined if keyword == '#ifdef' else not defined)
+  pre.ifprune.append(False)
+  state.outfile.write(line)
+
+# ----------------------------------------------
+def find_branch_end(state, at_else):
+  
+  # returns the line of the ELSE, if 'at_else', or ENDIF that goes with the
+  # conditional directive on the current line, or None
+  if state.keys is None:
+    state.keys = list(state.tokens)   # in line order
+  depth = 0
+  for index in state.keys[bisect.bisect_right(state.keys, state.count):]:
+    keyword = state.tokens[index][1]
+    if keyword in opening_conditionals:
+      depth += 1
+    elif keyword in ['#endif', 'endif', ]:
+      if depth == 0:
+        return index if keyword == '#endif' else None
+      depth -= 1
+    elif keyword in ['#else', 'else', ] and depth == 0 and at_else:
+      return index if keyword == '#else' else None
+  return None
+
+# ----------------------------------------------
+def prune_conditional(state, line, taken):
+  
+  # only the branch taken goes in the interim file, returns False if the
+  # conditional can't be pruned since it doesn't end in this file
+  pre = state.pre
+  branch_end = find_branch_end(state, True)
+  if branch_end is None:
+    return False
+  end = branch_end
+  if state.tokens[branch_end][1] == '#else':
+    count = state.count
+    state.count = branch_end
+    end = find_branch_end(state, False)
+    state.count = count
+    if end is None:
+      return False
+  
+  if taken:
+    pre.ifstack.append(True)
+    pre.ifprune.append(True)
+    state.outfile.write('; PRE-PREPROCESSOR, pruned: ' + line.strip() + \
+                        ' taken\n')
+  else:
+    if branch_end != end:     # the ELSE branch is taken
+      pre.ifstack.append(True)
+      pre.ifprune.append(True)
+    state.outfile.write('; PRE-PREPROCESSOR, pruned: ' + line.strip() + \
+                        ' not taken, to line ' + str(branch_end + 1) + '\n')
+    state.count = branch_end
+  return True
+
+# ----------------------------------------------
+def do_plain_if(state, line, pieces, keyword):
+  
+  # MPASM's own conditionals, whatever they set is not known for sure
+  if keyword == 'endif':
+    state.pre.plain_ifs = max(state.pre.plain_ifs - 1, 0)
+  else:
+    state.pre.plain_ifs += 1
+  state.outfile.write(line)
+
+# ----------------------------------------------
+def do_body(state, line, pieces, keyword):
+  
+  # macro and while bodies, run any number of times
+  bodies = state.pre.bodies
+  if keyword in ['macro', 'while', ]:
+    bodies.append(keyword)
+  elif bodies:
+    bodies.pop()
+  state.outfile.write(line)
+
+# ----------------------------------------------
+def do_radix(state, line, pieces, keyword):
+  
+  if keyword == 'radix':
+    state.pre.set_radix(' '.join(pieces[1:2]).lower())
+  else:
+    for option in ''.join(pieces[1:]).split(','):
+      if option[:2].lower() == 'r=':
+        state.pre.set_radix(option[2:].lower())
+  state.outfile.write(line)
+
+# ----------------------------------------------
+def do_assign(state, line, pieces, keyword):
+  
+  # variable = value, variable += value, variable++ and so on
+  name, operator = pieces[:2]
+  if operator == '=':
+    text = ' '.join(pieces[2:])
+  elif operator in ['++', '--', ]:
+    text = name + ' ' + operator[0] + ' 1'
+  else:
+    text = name + ' ' + operator[:-1] + ' (' + ' '.join(pieces[2:]) + ')'
+  state.pre.assign_expression(name, text)
+  state.outfile.write(line)
+
+# ----------------------------------------------
+def do_variable(state, line, pieces, keyword):
+  
+  # VARIABLE and CONSTANT, a list of names with or without a value
+  for part in ' '.join(pieces[1:]).split(','):
+    name, sep, text = part.partition('=')
+    if not name.strip():
+      continue
+    if sep:
+      state.pre.assign_expression(name.strip(), text)
+    else:
+      state.pre.assign(name.strip())
+  state.outfile.write(line)
+
+# ----------------------------------------------
+def do_define(state, line, pieces, keyword):
+  
+  pre = state.pre
+  outfile = state.outfile
+  if False in pre.ifstack:
+    pre.assign(pieces[1])
+    outfile.note('; PRE-PREPROCESSOR, skipping define directive due to condition stack\n')
+    outfile.write(line)
+    return
+  if pre.recording:
+    pre.changed('define', pieces[1].lower())
+  if len(pieces) > 2:
+    pre.defines[pieces[1].lower()] = pieces[2]
+    pre.assign(pieces[1], 'text', ' '.join(pieces[2:]))
+  else:
+    pre.defines[pieces[1].lower()] = None
+    pre.assign(pieces[1], 'text', None)
+  outfile.note('; PRE-PREPROCESSOR, caught #DEFINE: ' + \
+                pieces[1].lower() + '\n')
+  outfile.write(line)
+
+# ----------------------------------------------
+def do_setequ(state, line, pieces, keyword):
+  
+  # special case for catching 'set' and 'equ' function
+  if state.pre.recording:
+    state.pre.changed('define', pieces[0].lower())
+  state.pre.defines[pieces[0].lower()] = ' '.join(pieces[2:])
+  state.pre.assign_expression(pieces[0], ' '.join(pieces[2:]))
+  state.outfile.note("; PRE-PREPROCESSOR, caught 'set' or 'equ': " + \
+                     pieces[0].lower() + '\n')
+  state.outfile.write(line)
+
+# ----------------------------------------------
+def do_undefine(state, line, pieces, keyword):
+  
+  if state.pre.recording:
+    state.pre.changed('define', pieces[1].lower())
+  if pieces[1].lower() in state.pre.defines:
+    del state.pre.defines[pieces[1].lower()]
+  state.pre.assign(pieces[1])
+  state.outfile.note('; PRE-PREPROCESSOR, caught #UNDEFINE: ' + \
+                     pieces[1].lower() + '\n')
+  state.outfile.write(line)
+
+# ----------------------------------------------
+def do_include(state, line, pieces, keyword):
+  
+  pre = state.pre
+  outfile = state.outfile
+  recfn = pieces[1]
+  if recfn[:1] == '<':
+    recfn = recfn[1:-1]
+  if False in pre.ifstack:
+    # conditional says to not include it
+    outfile.note('; PRE-PREPROCESSOR, skipping include directive due to condition stack\n')
+    outfile.write(line)
+    if pre.prune:
+      pre.forget_include(recfn, set())
+    return
+  path = os.path.abspath(recfn)
+  guard = pre.guards.get(path)
+  if pre.recording:
+    pre.seen('guard', path)
+    if guard is not None and guard is not True:
+      pre.seen('define', guard.lower())
+  if guard is True or (guard is not None and guard.lower() in pre.defines):
+    # read already, and it would all be left out this time
+    outfile.write('; PRE-PREPROCESSOR, skipping included file read ' + \
+                  'already: ' + recfn + '\n')
+    if pre.stats is not None:
+      pre.stats.file(recfn)['skipped'] += 1
+    return
+  try:
+    entry = pre.load(recfn)
+  except Exception:
+    outfile.note('; PRE-PREPROCESSOR, failed to open include file: ' + \
+                  recfn + '\n')
+    outfile.write(line)
+    print('PRE WARNING: failed to open include file: ' + recfn, file=sys.stderr)
+    for expansion in pre.recording:
+      expansion.warnings.append('PRE WARNING: failed to open include file: ' + \
+                                recfn)
+    pre.opened_files[recfn] = None
+    pre.forget_everything()
+    return
+  # kept only when the assembler is sure to read it here, and just once
+  if not pre.certain():
+    pass
+  elif entry['once']:
+    pre.guards[path] = True
+    pre.changed('guard', path)
+  elif entry['guard']:
+    pre.guards[path] = entry['guard']
+    pre.changed('guard', path)
+  # skip the file if there are no "INSERT" and "SECTION" directives in it
+  if not entry['special']:
+    outfile.note('; PRE-PREPROCESSOR, skipping expanding included file: ' \
+                  + recfn + '\n')
+    outfile.write(line)
+    if pre.prune:
+      pre.forget_include(recfn, set(), entry)
+    return
+  pre.includes.append((path, check_include(state, recfn, path)))
+  outfile.write('; PRE-PREPROCESSOR, including: ' + recfn + '\n')
+  stack_balance = len(pre.ifstack)
+  if pre.memo and not pre.analyzers:
+    expand_include(state, recfn, path, entry)
+  else:
+    parse_file(pre, entry['lines'], entry['tokens'], outfile, recfn)
+  pre.includes.pop()
+  if len(pre.ifstack) != stack_balance:
+    print('PRE SERIOUS WARNING: conditional stack length altered after ' + \
+          'INCLUDE directive in file: ' + recfn, file=sys.stderr)
+  outfile.mark(state.filename, state.count + 1, fixed=True)
+  outfile.write('\n')
+
+# ----------------------------------------------
+def check_include(state, recfn, path):
+  
+  # stops a file including itself forever, returns what is kept to check it
+  # the next time, the state it is included with; when it is in the include
+  # chain already, the same state again can only go round the same way
+  pre = state.pre
+  snapshot = pre.snapshot()
+  if (path, snapshot) in pre.includes:
+    include_error(state, recfn, 'include cycle, ' + recfn + \
+                  ' is included again with nothing changed')
+  if len(pre.includes) >= include_limit:
+    include_error(state, recfn, 'includes nested deeper than ' + \
+                  str(include_limit) + ' files')
+  return snapshot
+
+# ----------------------------------------------
+def include_error(state, recfn, message):
+  
+  # with the chain of includes to it
+  pre = state.pre
+  lines = [message, ] + ['- file: ' + frame.filename + ' line ' + \
+                         str(frame.count + 1) for frame in pre.frames]
+  lines.append('- file: ' + recfn)
+  for text in lines:
+    print('PRE-PREPROCESSOR ERROR: ' + text, file=sys.stderr)
+    pre.errfile.write('PRE-PREPROCESSOR ERROR: ' + text + '\n')
+    state.outfile.write('; PRE-PREPROCESSOR ERROR: ' + text + '\n')
+  sys.exit(1)
+
+# ----------------------------------------------
+class Prefetcher:
+  
+  # reads included files ahead of the parsing, into the memory cache, on up
+  # to 'prefetch_workers' threads started as files come up, each file once;
+  # the parsing still loads each file itself, waiting for a read ahead of it
+  # first, so a wrong guess only costs the read
+  
+  def __init__(self, pre):
+    self.pre = pre
+    self.lock = None      # held to change the rest, made with the first read
+    self.queue = None
+    self.reads = {}       # by absolute path, an Event set when it was read,
+                          # or None once loaded without one
+    self.threads = []
+    self.stopped = False
+  
+  def scan(self, tokens, least=1):
+    # the files included by the split up 'tokens', going by what is defined
+    # now for the #IFDEF and #IFNDEF around them, when there are at least
+    # 'least' of them
+    pre = self.pre
+    if False in pre.ifstack:
+      return
+    found = []
+    taken = []
+    for pieces, keyword in tokens.values():
+      if keyword in ['#ifdef', '#ifndef', ] and len(pieces) > 1:
+        defined = pieces[1].lower() in pre.defines
+        taken.append(defined if keyword == '#ifdef' else not defined)
+      elif keyword == '#if':
+        taken.append(None)
+      elif keyword == '#else' and taken:
+        taken[-1] = None if taken[-1] is None else not taken[-1]
+      elif keyword == '#endif' and taken:
+        taken.pop()
+      elif keyword == '#include' and len(pieces) > 1 and False not in taken:
+        recfn = pieces[1]
+        if recfn[:1] == '<':
+          recfn = recfn[1:-1]
+        path = os.path.abspath(recfn)
+        guard = pre.guards.get(path)
+        if path in memory_cache or path in pre.overlays or guard is True or \
+           (guard is not None and guard.lower() in pre.defines):
+          continue
+        found.append((path, recfn))
+    if len(found) >= least:
+      for path, recfn in found:
+        self.add(path, recfn)
+  
+  def add(self, path, filename):
+    import threading
+    if self.lock is None:
+      # no threads yet, so nothing else is looking
+      import queue
+      self.lock = threading.Lock()
+      self.queue = queue.SimpleQueue()
+    with self.lock:
+      if self.stopped or path in self.reads:
+        return
+      self.reads[path] = threading.Event()
+      self.queue.put((path, filename))
+      if len(self.threads) < prefetch_workers:
+        thread = threading.Thread(target=self.work, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+  
+  def work(self):
+    # on each of the threads, and the files those include in turn
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      path, filename = item
+      try:
+        if not self.stopped:
+          entry = load_file(filename)
+          if entry['tokens'] is not None:
+            self.scan(entry['tokens'])
+      except Exception:
+        pass      # comes again when the parsing loads it
+      finally:
+        self.reads[path].set()
+  
+  def wait(self, filename):
+    # a file is never read on two threads at once
+    if self.lock is None:
+      self.reads.setdefault(os.path.abspath(filename), None)
+      return
+    with self.lock:
+      read = self.reads.setdefault(os.path.abspath(filename), None)
+    if read is not None:
+      read.wait()
+  
+  def stop(self):
+    # the files not started yet are dropped
+    if self.lock is None:
+      return
+    with self.lock:
+      self.stopped = True
+    for thread in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+
+# ----------------------------------------------
+def skip_special(state, line, keyword):
+  
+  pre = state.pre
+  # conditional says to not compile it, so strip out the special directive,
+  # returns True when it was stripped
+  if not False in pre.ifstack:
+    return False
+  outfile = state.outfile
+  outfile.note('; PRE-PREPROCESSOR, skipping special directive due ' + \
+               'to condition stack\n')
+  outfile.write('; PRE-PREPROCESSOR: ' + line.strip() + '\n')
+  outfile.note('; PRE-PREPROCESSOR: ' + str(pre.ifstack) + '\n')
+  if keyword == '#generate':
+    outfile.write('; PRE-PREPROCESSOR ERROR: stripping ' + keyword + '\n')
+    # need to get to the end of the GENERATE directive
+    read_block(state, '#endgen', 'GENERATE', '#generate')
+  if keyword in splice_directives:
+    outfile.write('; PRE-PREPROCESSOR ERROR: stripping ' + keyword + '\n')
+    # need to get to the end of the splice directive
+    read_block(state, '#endsplice', 'a splice')
+  return True
+
+# ----------------------------------------------
+def do_insert(state, line, pieces, keyword):
+  
+  pre = state.pre
+  # form of: #INSERT (macro_name) (section_name) [priority] [macro_arg]...
+  if skip_special(state, line, keyword):
+    return
+  outfile = state.outfile
+  sectionName = pieces[2].lower()
+  if pre.recording:
+    pre.seen('section', sectionName)
+  if sectionName in pre.sections:
+    if pre.sections[sectionName] is None:
+      outfile.write('; PRE-PREPROCESSOR, found INSERT directive after' + \
+                    ' SECTION directive in: ' + state.filename + '\n')
+      outfile.write('; PRE-PREPROCESSOR, SECTION directive was in: ' + \
+                    pre.completed_sections[sectionName] + '\n')
+      print('PRE-PREPROCESSOR ERROR: found INSERT directive after ' + \
+            'SECTION directive in: ' + state.filename, file=sys.stderr)
+      print('PRE-PREPROCESSOR ERROR: SECTION directive was in: ' + \
+            pre.completed_sections[sectionName], file=sys.stderr)
+      sys.exit(1)
+  else:
+    pre.sections[sectionName] = []
+  if len(pieces) > 3:
+    try:
+      priority = float(pieces[3])
+    except ValueError:
+      outfile.write('; PRE-PREPROCESSOR, bad priority value\n')
+      outfile.write(line)
+      print('PRE-PREPROCESSOR ERROR: bad priority value in: ' + \
+            state.filename + ' at line: ' + str(state.count), file=sys.stderr)
+      print('PRE-PREPROCESSOR ERROR: ' + line, file=sys.stderr)
+      sys.exit(1)
+  else:
+    priority = 100.0
+  if len(pieces) > 4:
+    macroargs = pieces[4:]
+  else:
+    macroargs = None
+  item = (priority, pieces[1], macroargs, state.filename, state.count + 1)
+  heapq.heappush(pre.sections[sectionName], item)
+  for expansion in pre.recording:
+    expansion.inserts.append((sectionName, item))
+  outfile.note('; PRE-PREPROCESSOR, found INSERT directive\n')
+  outfile.write('; PRE-PREPROCESSOR: ' + line.strip() + '\n')
+
+# ----------------------------------------------
+def do_splice(state, line, pieces, keyword):
+  
+  if skip_special(state, line, keyword):
+    return
+  state.splices[keyword] = read_block(state, '#endsplice', keyword[1:].upper())
+
+# ----------------------------------------------
+def do_endsplice(state, line, pieces, keyword):
+  
+  # nothing to do outside of a splice
+  skip_special(state, line, keyword)
+
+# ----------------------------------------------
+def do_section(state, line, pieces, keyword):
+  
+  # form of: #SECTION (section_name) [macro_args] [...]
+  pre = state.pre
+  if skip_special(state, line, keyword):
+    return
+  for expansion in pre.recording:
+    expansion.cacheable = False   # what it writes depends on every INSERT
+  outfile = state.outfile
+  splices = state.splices
+  sectionName = pieces[1].lower()
+  if not sectionName in pre.sections:
+    print('PRE WARNING: no sections for SECTION directive: ' + \
+          sectionName, file=sys.stderr)
+    outfile.write('; PRE-PREPROCESSOR, WARNING, nothing found for SECTION directive\n')
+    outfile.write('; PRE-PREPROCESSOR: ' + line.strip() + '\n')
+    if splices['#spliceempty']:
+      outfile.note('; PRE-PREPROCESSOR: empty splice section\n')
+      for line in splices['#spliceempty']:
+        outfile.write(line)
+  else:
+    outfile.note('; PRE-PREPROCESSOR, found SECTION directive\n')
+    outfile.write('; PRE-PREPROCESSOR: ' + line.strip() + '\n')
+    if len(pieces) > 2:
+      macro_args = ' ' + ' '.join(pieces[2:])
+    else:
+      macro_args = ''
+    
+    for line in splices['#splicebefore']:
+      outfile.write(line)
+    between = compile_template(state, splices['#splicebetween'], 0, ['i', ])
+    after = compile_template(state, splices['#spliceafter'], 0, ['i', ])
+    count2 = 1
+    
+    while pre.sections[sectionName]:
+      macro, args, insfile, insline = \
+        heapq.heappop(pre.sections[sectionName])[1:]
+      outfile.note('; PRE-PREPROCESSOR: section: ' + sectionName + \
+                   ' inserting macro: ' + macro + '\n')
+      outfile.mark(state.filename, state.count + 1, fixed=True,
+                   note='#INSERT at ' + insfile + ' ' + str(insline))
+      if args:    # args taken from the INSERT directive
+        outfile.write('\t' + macro + ' ' + ', '.join(args) + '\n')
+      else:       # args taken from the SECTION directive
+        outfile.write('\t' + macro + macro_args + '\n')
+      outfile.mark(state.filename, state.count + 1, fixed=True)
+      if len(pre.sections[sectionName]):
+        outfile.write(render_text(state, between, {'i': count2, }))
+      count2 += 1
+    
+    outfile.write(render_text(state, after, {'i': count2, }))
+  
+  pre.sections[sectionName] = None
+  pre.completed_sections[sectionName] = state.filename
+  for name in splices:
+    pre.forget_lines(splices[name])
+    splices[name] = []
+
+# ----------------------------------------------
+def do_generate(state, line, pieces, keyword):
+  
+  # form of: #GENERATE (start) (end) [step] [variable]
+  if skip_special(state, line, keyword):
+    return
+  outfile = state.outfile
+  outfile.note('; PRE-PREPROCESSOR, found GENERATE directive\n')
+  outfile.write('; PRE-PREPROCESSOR: ' + line.strip() + '\n')
+  arguments, variable = generate_arguments(pieces[1:])
+  counts = generate_counts(state, line, arguments)
+  
+  # read for the section we're going to generate/loop, compiled once and
+  # rendered for every count before it is written out all together
+  first = state.count + 2
+  section = read_block(state, '#endgen', 'GENERATE', '#generate')
+  body = compile_template(state, section, first, [variable, ])
+  rendered = []
+  render_generate(state, first - 1, counts, variable, body, {}, rendered)
+  outfile.write_marked(state.filename, rendered)
+  state.pre.forget_lines(section)
+
+# ----------------------------------------------
+include_limit = 100     # files inside each other, well short of the
+                        # interpreter's recursion limit
+prefetch_workers = 4    # included files read ahead at once
+splice_directives = ['#splicebefore', '#splicebetween', '#spliceafter',
+                     '#spliceempty', ]
+# these need at least one argument
+argument_directives = set(['#ifdef', '#ifndef', '#define', '#undefine',
+                           '#include', '#insert', '#section', ])
+directives = {
+  '#endif': do_endif,
+  '#else': do_else,
+  '#if': do_if,
+  '#ifdef': do_ifdef,
+  '#ifndef': do_ifdef,
+  '#define': do_define,
+  'set': do_setequ,
+  'equ': do_setequ,
+  '#undefine': do_undefine,
+  '#include': do_include,
+  '#insert': do_insert,
+  '#section': do_section,
+  '#generate': do_generate,
+  '#splicebefore': do_splice,
+  '#splicebetween': do_splice,
+  '#spliceafter': do_splice,
+  '#spliceempty': do_splice,
+  '#endsplice': do_endsplice,
+  'if': do_plain_if,
+  'ifdef': do_plain_if,
+  'ifndef': do_plain_if,
+  'endif': do_plain_if,
+  'macro': do_body,
+  'while': do_body,
+  'endm': do_body,
+  'endw': do_body,
+  'radix': do_radix,
+  'list': do_radix,
+  'assign': do_assign,
+  'variable': do_variable,
+  'constant': do_variable,
+}
+# these start a conditional block, with or without the '#'
+opening_conditionals = set(['#if', '#ifdef', '#ifndef', 'if', 'ifdef',
+                            'ifndef', ])
+
+
+# -----------------------------------------------------------------------------
+# GENERATE and splice bodies, compiled once into a template and then rendered
+# for every count; a template is a list of blocks, ['text', line, format,
+# fields] for a run of lines made into one format string, with the loop
+# variables and expressions to fill in as its fields, or ['generate', line,
+# directive, variable, body] for a GENERATE nested in it, 'line' being the
+# line of the file the block starts on
+
+identifier_pattern = r'[A-Za-z_]\w*$'
+
+def compile_template(state, lines, first, names):
+  
+  # 'names' are the loop variables that can be used in it
+  blocks = []
+  form = []
+  fields = []
+  start = first
+  index = 0
+  while index < len(lines):
+    words = lines[index].split(';', 1)[0].split()
+    if not words or words[0].lower() != '#generate':
+      form.append(compile_line(state, lines[index], names, fields))
+      index += 1
+      continue
+    
+    # a nested GENERATE, up to its ENDGEN
+    if form:
+      blocks.append(['text', start, ''.join(form), fields, ])
+      form = []
+      fields = []
+    depth = 0
+    end = index + 1
+    while end < len(lines):
+      keyword = lines[end].split(';', 1)[0].split()[:1]
+      if keyword and keyword[0].lower() == '#generate':
+        depth += 1
+      elif keyword and keyword[0].lower() == '#endgen':
+        if depth == 0:
+          break
+        depth -= 1
+      end += 1
+    variable = generate_arguments(words[1:])[1]
+    directive_fields = []
+    directive = ['text', first + index,
+                 compile_line(state, lines[index], names, directive_fields),
+                 directive_fields, ]
+    body = compile_template(state, lines[index + 1:end], first + index + 1,
+                            names + [variable, ])
+    blocks.append(['generate', first + index, [directive, ], variable, body, ])
+    index = end + 1
+    start = first + index
+  if form:
+    blocks.append(['text', start, ''.join(form), fields, ])
+  return blocks
+
+# ----------------------------------------------
+def compile_line(state, line, names, fields):
+  
+  # returns the line as a format string, adding what it substitutes to
+  # 'fields', a loop variable by name or an expression as its tokens
+  import re
+  
+  pre = state.pre
+  form = []
+  position = 0
+  while True:
+    start = line.find('{', position)
+    end = line.find('}', start + 1)
+    if start < 0 or end < 0:
+      break
+    form.append(line[position:start].replace('{', '{{').replace('}', '}}'))
+    name = line[start + 1:end]
+    position = end + 1
+    width = 0
+    if pre.recording and name not in names:
+      pre.seen('define', name.lower())
+    if name in names:     # simple substitution for current count
+      field = name
+    elif pre.defines.get(name.lower()):
+      # substitution with what's been #DEFINEd, if it exists
+      form.append(pre.defines[name.lower()].replace('{', '{{') \
+                                           .replace('}', '}}'))
+      continue
+    elif len(set(name)) == 1 and name[0] in names:
+      # substitution with the count, but add leading zeros
+      field = name[0]
+      width = len(name)
+    else:
+      # an expression, worked out now when it has no loop variables in it
+      tokens = re.findall(token_pattern, name)
+      if not tokens or ''.join(tokens) != ''.join(name.split()):
+        substitution_error(state, line)
+      field = tuple(tokens)
+      if not set(tokens) & set(names):
+        form.append(str(field_value(state, field, {}, line)))
+        continue
+    if field not in fields:
+      fields.append(field)
+    form.append('{' + str(fields.index(field)) + \
+                (':0' + str(width) + 'd}' if width else '}'))
+  form.append(line[position:].replace('{', '{{').replace('}', '}}'))
+  return ''.join(form)
+
+# ----------------------------------------------
+def field_value(state, field, values, line):
+  
+  if type(field) is str:
+    return values[field]
+  # an expression, with the loop variables put in as decimal numbers
+  tokens = []
+  for token in field:
+    if token not in values:
+      tokens.append(token)
+    elif values[token] < 0:
+      tokens += ['(', '-', '.' + str(-values[token]), ')', ]
+    else:
+      tokens.append('.' + str(values[token]))
+  try:
+    value, position = parse_binary(state.pre, tokens, 0, 0, 0)
+    if position != len(tokens):
+      raise Unresolved()
+  except Unresolved:
+    substitution_error(state, line)
+  return value
+
+# ----------------------------------------------
+def substitution_error(state, line):
+  
+  state.outfile.write('; PRE-PREPROCESSOR ERROR: bad substitution ' + \
+                      'data in: ' + state.filename + '\n')
+  state.outfile.write('; PRE-PREPROCESSOR: ' + line.strip() + '\n')
+  print('PRE-PREPROCESSOR ERROR: bad substitution data in ' + \
+        'file: ' + state.filename, file=sys.stderr)
+  print('PRE-PREPROCESSOR: line: ' + line.strip(), file=sys.stderr)
+  sys.exit(1)
+
+# ----------------------------------------------
+def generate_arguments(arguments):
+  
+  # returns the range arguments and the loop variable, 'i' unless one is given
+  import re
+  
+  if len(arguments) > 2 and re.match(identifier_pattern, arguments[-1]):
+    return arguments[:-1], arguments[-1]
+  return arguments, 'i'
+
+# ----------------------------------------------
+def generate_counts(state, line, arguments):
+  
+  # the range numbers are decimal and inclusive to both limits
+  try:
+    if len(arguments) not in [2, 3, ]:
+      raise ValueError()
+    fromcount = int(arguments[0])
+    tocount = int(arguments[1])
+    step = int(arguments[2]) if len(arguments) > 2 else 1
+    return range(fromcount, tocount + (1 if step > 0 else -1), step)
+  except:
+    outfile = state.outfile
+    outfile.write('; PRE-PREPROCESSOR ERROR: bad GENERATE directive count\n')
+    outfile.write('; PRE-PREPROCESSOR: ' + line.strip() + '\n')
+    print('PRE-PREPROCESSOR ERROR: bad GENERATE directive count', \
+          file=sys.stderr)
+    print('PRE-PREPROCESSOR: ' + line.strip(), file=sys.stderr)
+    sys.exit(1)
+
+# ----------------------------------------------
+def render_generate(state, line, counts, variable, body, values, rendered):
+  
+  # adds the [line, fixed, note, text] pieces for every count to 'rendered'
+  if state.pre.stats is not None:
+    state.pre.stats.generate_iterations += len(counts)
+  values = dict(values)
+  values[variable] = None
+  note = '#GENERATE at line ' + str(line) + ' ' + \
+         ''.join([name + '=' + str(values[name]) + ' ' for name in values \
+                  if name != variable])
+  if len(body) == 1 and body[0][0] == 'text' and body[0][3] == [variable, ]:
+    # just the count put in, the most common
+    first, form = body[0][1:3]
+    for count in counts:
+      rendered.append([first, False, note + variable + '=' + str(count),
+                       form.format(count)])
+    return
+  for count in counts:
+    values[variable] = count
+    render(state, body, values, note + variable + '=' + str(count), rendered)
+
+# ----------------------------------------------
+def render(state, blocks, values, note, rendered):
+  
+  for block in blocks:
+    if block[0] == 'text':
+      form, fields = block[2:]
+      rendered.append([block[1], False, note, form.format(
+        *[field_value(state, field, values, form) for field in fields])])
+      continue
+    line, directive, variable, body = block[1:]
+    text = render_text(state, directive, values)
+    rendered.append([line, True, note,
+                     ('; PRE-PREPROCESSOR, found GENERATE directive\n' \
+                      if state.outfile.notes else '') + \
+                     '; PRE-PREPROCESSOR: ' + text.strip() + '\n'])
+    arguments = generate_arguments(text.split(';', 1)[0].split()[1:])[0]
+    counts = generate_counts(state, text, arguments)
+    render_generate(state, line, counts, variable, body, values, rendered)
+
+# ----------------------------------------------
+def render_text(state, blocks, values):
+  
+  rendered = []
+  render(state, blocks, values, None, rendered)
+  return ''.join([piece[3] for piece in rendered])
+
+
+# -----------------------------------------------------------------------------
+# analyzers, watching the directives go by in the one pass; a Preprocessor
+# given some tells each one of every directive after it is handled, and of the
+# end of the run, and puts together what they found in its report()
+
+nesting_limit = 16      # MPASM's limit on conditionals inside each other
+report_limit = 100      # findings of each kind kept in the report
+report_version = 1
+
+class Analyzer:
+  
+  name = None           # what its part of the report is called
+  
+  def directive(self, state, keyword, pieces, count):
+    # after the directive on line 'count' of state.filename is handled
+    pass
+  
+  def finish(self, pre):
+    # at the end of the run, before checking every INSERT found its SECTION
+    pass
+  
+  def report(self):
+    # what was found, made of things json can write
+    return {}
+  
+  def findings(self):
+    # the problems found, as messages
+    return []
+
+# ----------------------------------------------
+class NestingAnalyzer(Analyzer):
+  
+  # how deep the conditionals MPASM sees go, pruned ones are not counted
+  
+  name = 'if_nesting'
+  keywords = opening_conditionals | set(['#else', '#endif', 'endif', ])
+  
+  def __init__(self, limit=nesting_limit):
+    self.limit = limit
+    self.stack = []       # [file, line, text] of each conditional open
+    self.deepest = []     # the stack when it was deepest
+    self.over = []        # the stack each time it got to the limit
+    self.over_count = 0
+  
+  def directive(self, state, keyword, pieces, count):
+    if keyword not in self.keywords:
+      return
+    pre = state.pre
+    depth = pre.ifprune.count(False) + pre.plain_ifs
+    del self.stack[depth:]
+    while len(self.stack) < depth:
+      self.stack.append([state.filename, count + 1, state.lines[count].strip()])
+    if keyword not in opening_conditionals:
+      return
+    if depth > len(self.deepest):
+      self.deepest = list(self.stack)
+    if depth >= self.limit:
+      self.over_count += 1
+      if len(self.over) < report_limit:
+        self.over.append(list(self.stack))
+  
+  def report(self):
+    return {'limit': self.limit, 'deepest': len(self.deepest),
+            'deepest_stack': self.deepest, 'over_limit': self.over_count,
+            'over_limit_stacks': self.over, }
+  
+  def findings(self):
+    return ['nesting depth at ' + str(len(stack)) + ' in ' + stack[-1][0] + \
+            ' at line ' + str(stack[-1][1]) for stack in self.over]
+
+# ----------------------------------------------
+class UndefinedAnalyzer(Analyzer):
+  
+  # symbols tested with IFDEF or IFNDEF that nothing in the run defines, most
+  # likely spelled wrong
+  
+  name = 'undefined_ifdef'
+  
+  def __init__(self):
+    self.tested = {}      # by lower case name, [name, file, line] first used
+    self.defined = set()
+  
+  def directive(self, state, keyword, pieces, count):
+    if keyword in ['#ifdef', '#ifndef', 'ifdef', 'ifndef', ]:
+      if len(pieces) > 1 and pieces[1].lower() not in self.tested:
+        self.tested[pieces[1].lower()] = [pieces[1], state.filename, count + 1]
+    elif keyword == '#define':
+      self.defined.add(pieces[1].lower())
+    elif keyword in ['set', 'equ', 'assign', ]:
+      self.defined.add(pieces[0].lower())
+    elif keyword in ['variable', 'constant', ]:
+      for part in ' '.join(pieces[1:]).split(','):
+        self.defined.add(part.partition('=')[0].strip().lower())
+  
+  def finish(self, pre):
+    self.defined.update(pre.defines)
+  
+  def report(self):
+    return [self.tested[name] for name in sorted(self.tested) \
+            if name not in self.defined][:report_limit]
+  
+  def findings(self):
+    return ['symbol ' + name + ' is never defined, tested in ' + filename + \
+            ' at line ' + str(line) for name, filename, line in self.report()]
+
+# ----------------------------------------------
+class SectionAnalyzer(Analyzer):
+  
+  # where each SECTION is and what was inserted in it
+  
+  name = 'sections'
+  
+  def __init__(self):
+    self.sections = {}
+  
+  def section(self, name):
+    if name not in self.sections:
+      self.sections[name] = {'file': None, 'line': None, 'inserts': [], }
+    return self.sections[name]
+  
+  def directive(self, state, keyword, pieces, count):
+    if keyword not in ['#insert', '#section', ] or False in state.pre.ifstack:
+      return
+    if keyword == '#insert':
+      self.section(pieces[2].lower())['inserts'].append(
+        [pieces[1], state.filename, count + 1])
+    else:
+      entry = self.section(pieces[1].lower())
+      entry['file'] = state.filename
+      entry['line'] = count + 1
+  
+  def report(self):
+    return {'sections': len(self.sections),
+            'inserts': sum([len(entry['inserts']) \
+                            for entry in self.sections.values()]),
+            'by_name': self.sections, }
+  
+  def findings(self):
+    messages = []
+    for name in sorted(self.sections):
+      entry = self.sections[name]
+      if entry['file'] is None:
+        messages.append('no SECTION directive for section: ' + name)
+      elif not entry['inserts']:
+        messages.append('nothing inserted in SECTION ' + name + ' in ' + \
+                        entry['file'] + ' at line ' + str(entry['line']))
+    return messages
+
+# ----------------------------------------------
+def default_analyzers():
+  
+  return [NestingAnalyzer(), UndefinedAnalyzer(), SectionAnalyzer(), ]
+
+# ----------------------------------------------
+def write_report(pre, filename):
+  
+  import json
+  
+  try:
+    tempfn = filename + '.' + str(os.getpid())
+    with open(tempfn, 'w') as f:
+      json.dump(pre.report(), f, indent=1)
+      f.write('\n')
+    os.replace(tempfn, filename)
+  except Exception as msg:
+    print('PRE WARNING: failed to write analysis report: ' + str(msg), \
+          file=sys.stderr)
+
+
+# -----------------------------------------------------------------------------
+# timings and counts for --stats, a Preprocessor only keeps them when given a
+# Stats, otherwise each hook is one check for None
+
+stats_version = 1
+
+class Stats:
+  
+  def __init__(self):
+    import time
+    self.clock = time.perf_counter
+    self.started = self.clock()
+    self.files = {}       # by file name, {'lines', 'load', 'parse', 'total'}
+    self.directives = {}  # by keyword, [count, seconds], an include's time
+                          # has the file it includes in it
+    self.generate_iterations = 0
+    self.macros_dropped = 0
+    self.interim_bytes = None
+    self.assembler = None     # seconds waiting on MPASM
+    self.nested = []      # time taken by includes in each file being parsed
+  
+  def file(self, filename):
+    if filename not in self.files:
+      self.files[filename] = {'lines': 0, 'load': 0.0, 'parse': 0.0,
+                              'total': 0.0, 'skipped': 0, 'replayed': 0, }
+    return self.files[filename]
+  
+  def loaded(self, filename, seconds):
+    self.file(filename)['load'] += seconds
+    if self.nested:
+      self.nested[-1] += seconds
+  
+  def parsed(self, filename, lines, seconds):
+    # 'parse' is without the files it includes, 'total' with them
+    entry = self.file(filename)
+    entry['lines'] += lines
+    entry['parse'] += seconds - self.nested.pop()
+    entry['total'] += seconds
+    if self.nested:
+      self.nested[-1] += seconds
+  
+  def directive(self, handler, state, line, pieces, keyword):
+    start = self.clock()
+    handler(state, line, pieces, keyword)
+    if keyword not in self.directives:
+      self.directives[keyword] = [0, 0.0]
+    entry = self.directives[keyword]
+    entry[0] += 1
+    entry[1] += self.clock() - start
+  
+  def report(self):
+    return {'version': stats_version, 'wall': self.clock() - self.started,
+            'load': sum([entry['load'] for entry in self.files.values()]),
+            'parse': sum([entry['parse'] for entry in self.files.values()]),
+            'assembler': self.assembler,
+            'lines': sum([entry['lines'] for entry in self.files.values()]),
+            'interim_bytes': self.interim_bytes,
+            'generate_iterations': self.generate_iterations,
+            'macros_dropped': self.macros_dropped,
+            'skipped_includes': sum([entry['skipped'] \
+                                     for entry in self.files.values()]),
+            'replayed_includes': sum([entry['replayed'] \
+                                      for entry in self.files.values()]),
+            'directives': self.directives, 'files': self.files, }
+  
+  def summary(self):
+    # a few lines for people to read
+    report = self.report()
+    lines = ['total ' + format(report['wall'], '.3f') + ' s, loading ' + \
+             format(report['load'], '.3f') + ' s, parsing ' + \
+             format(report['parse'], '.3f') + ' s' + \
+             ('' if self.assembler is None else ', assembler ' + \
+              format(self.assembler, '.3f') + ' s'),
+             str(report['lines']) + ' lines in ' + str(len(self.files)) + \
+             ' files, ' + str(self.generate_iterations) + \
+             ' GENERATE iterations, ' + str(report['skipped_includes']) + \
+             ' includes skipped as read already, ' + \
+             str(report['replayed_includes']) + ' replayed, ' + \
+             str(self.macros_dropped) + ' unused macros left out' + \
+             ('' if self.interim_bytes is None else ', ' + \
+              str(self.interim_bytes) + ' bytes written'), ]
+    slowest = sorted(self.files.items(), reverse=True,
+                     key=lambda item: item[1]['load'] + item[1]['parse'])
+    for filename, entry in slowest[:5]:
+      lines.append('file ' + filename + ': ' + str(entry['lines']) + \
+                   ' lines, loading ' + format(entry['load'], '.3f') + \
+                   ' s, parsing ' + format(entry['parse'], '.3f') + ' s')
+    for keyword in sorted(self.directives):
+      count, seconds = self.directives[keyword]
+      lines.append('directive ' + keyword + ': ' + str(count) + ' in ' + \
+                   format(seconds, '.3f') + ' s')
+    return lines
+
+# ----------------------------------------------
+def write_stats(stats, filename):
+  
+  import json
+  
+  for line in stats.summary():
+    print('PRE INFO: stats: ' + line, file=sys.stderr)
+  try:
+    tempfn = filename + '.' + str(os.getpid())
+    with open(tempfn, 'w') as f:
+      json.dump(stats.report(), f, indent=1)
+      f.write('\n')
+    os.replace(tempfn, filename)
+  except Exception as msg:
+    print('PRE WARNING: failed to write stats: ' + str(msg), file=sys.stderr)
+
+# -----------------------------------------------------------------------------
+# include expansions, each included file is recorded as it is expanded, with
+# the parts of the state it read and what it left there, and an include of the
+# same file that finds the same values there is written out again from the
+# recording without reading the file; kept in memory and, with the include
+# cache, on disk
+
+expansion_version = 1
+expansion_limit = 16    # kept of each file, the latest first
+expansions = {}         # by absolute path, the recordings of each file
+
+class Expansion:
+  
+  def __init__(self, key):
+    self.key = key
+    self.reads = {}       # by (kind, name), the value first read
+    self.written = set()  # (kind, name) of each part changed
+    self.cleared = False  # every symbol was forgotten
+    self.inserts = []     # (section name, heap entry) of each INSERT
+    self.warnings = []
+    self.cacheable = True
+  
+  def seen(self, kind, name, value):
+    # only what was there before the file counts
+    if (kind, name) in self.reads or (kind, name) in self.written or \
+       (self.cleared and kind == 'symbol'):
+      return
+    self.reads[(kind, name)] = value
+
+# ----------------------------------------------
+def expand_include(state, recfn, path, entry):
+  
+  pre = state.pre
+  outfile = state.outfile
+  key = (recfn, entry['hash'], os.getcwd(), pre.prune, outfile.notes,
+         pre.verbosity, tuple(pre.ifstack), tuple(pre.ifprune),
+         tuple(pre.bodies), pre.plain_ifs)
+  outfile.mark(recfn, 1)
+  first = len(outfile.entries) - 1
+  record = find_expansion(pre, path, key)
+  if record is not None:
+    replay_expansion(pre, outfile, first, record)
+    if pre.stats is not None:
+      pre.stats.file(recfn)['replayed'] += 1
+    return
+  
+  # written to memory while it is recorded, then passed on
+  expansion = Expansion(key)
+  start = outfile.line
+  sink = outfile.file
+  outfile.file = io.StringIO()
+  pre.recording.append(expansion)
+  try:
+    parse_file(pre, entry['lines'], entry['tokens'], outfile, recfn)
+  finally:
+    pre.recording.pop()
+    text = outfile.file.getvalue()
+    outfile.file = sink
+    sink.write(text)
+  if not expansion.cacheable or key[6:] != (tuple(pre.ifstack),
+     tuple(pre.ifprune), tuple(pre.bodies), pre.plain_ifs):
+    return
+  
+  names = {number: name for name, number in outfile.file_numbers.items()}
+  keep_expansion(path, {
+    'key': key,
+    'reads': [(kind, name, value) \
+              for (kind, name), value in expansion.reads.items()],
+    'cleared': expansion.cleared,
+    'written': [(kind, name, pre.current(kind, name)) \
+                for kind, name in expansion.written],
+    'inserts': expansion.inserts, 'warnings': expansion.warnings,
+    'text': text, 'lines': outfile.line - start,
+    'entries': [[mark[0] - start, names[mark[1]], ] + mark[2:] \
+                for mark in outfile.entries[first:]], })
+
+# ----------------------------------------------
+def find_expansion(pre, path, key):
+  
+  if path not in expansions:
+    expansions[path] = read_expansions(path)
+  for record in expansions[path]:
+    if record['key'] == key and \
+       all(pre.current(kind, name) == value \
+           for kind, name, value in record['reads']):
+      return record
+  return None
+
+# ----------------------------------------------
+def replay_expansion(pre, outfile, first, record):
+  
+  # does all the file did, so expansions being recorded see it too
+  for kind, name, value in record['reads']:
+    if kind != 'file':
+      pre.seen(kind, name)
+    elif value is None:
+      pre.seen(kind, name, None)
+      pre.opened_files[name] = None
+    else:
+      pre.load(name)
+  if record['cleared']:
+    pre.forget_everything()
+  for kind, name, value in record['written']:
+    pre.restore(kind, name, value)
+  for sectionName, item in record['inserts']:
+    heapq.heappush(pre.sections.setdefault(sectionName, []), item)
+    for expansion in pre.recording:
+      expansion.inserts.append((sectionName, item))
+  for message in record['warnings']:
+    print(message, file=sys.stderr)
+    for expansion in pre.recording:
+      expansion.warnings.append(message)
+  
+  base = outfile.line
+  del outfile.entries[first:]
+  for mark in record['entries']:
+    outfile.entries.append([base + mark[0], outfile.number(mark[1]), ] + \
+                           mark[2:])
+  outfile.file.write(record['text'])
+  outfile.line += record['lines']
+
+# ----------------------------------------------
+def expansions_file(path):
+  
+  import hashlib
+  
+  return os.path.join(cache_dir, hashlib.sha1(path.encode()).hexdigest() + \
+                      '.exp')
+
+# ----------------------------------------------
+def read_expansions(path):
+  
+  if not cache_dir:
+    return []
+  import pickle
+  try:
+    with open(expansions_file(path), 'rb') as f:
+      stored = pickle.load(f)
+  except Exception:
+    return []
+  if stored.get('version') != expansion_version or \
+     stored.get('program') != program_id():
+    return []
+  return stored['expansions']
+
+# ----------------------------------------------
+def keep_expansion(path, record):
+  
+  # the ones for other contents of the file are no use any more
+  records = [record, ] + [old for old in expansions.get(path, []) \
+                          if old['key'][1] == record['key'][1]]
+  expansions[path] = records[:expansion_limit]
+  if not cache_dir:
+    return
+  import pickle
+  filename = expansions_file(path)
+  try:
+    os.makedirs(cache_dir, exist_ok=True)
+    tempfn = filename + '.' + str(os.getpid())
+    with open(tempfn, 'wb') as f:
+      pickle.dump({'version': expansion_version, 'program': program_id(),
+                   'expansions': expansions[path], }, f,
+                  pickle.HIGHEST_PROTOCOL)
+    os.replace(tempfn, filename)
+  except Exception:
+    pass    # only kept in memory then
+
+# -----------------------------------------------------------------------------
+# unused macros, with '--prune-macros' the interim file is kept in memory to
+# the end and the macro definitions nothing calls are taken out of it; the
+# finished text is searched rather than each file as it is parsed, so replayed
+# includes and GENERATE and SPLICE output count the same as the rest.  A macro
+# is kept when its name is in the code outside its own body, in a file left
+# for the assembler to include, or could be made with #v()
+
+macro_pattern = r'^[ \t]*(?:([A-Za-z_?][\w?]*):?[ \t]+(macro)|' + \
+                r'(?:[A-Za-z_?][\w?]*:?[ \t]+)?(endm))(?![\w?])'
+word_pattern = r'[a-z_?][\w?]*'
+comment_pattern = r'"[^"\n]*"|\'[^\'\n]*\'|;[^\n]*'
+include_pattern = r'^[ \t]*#?include[ \t]+("[^"\n]*"|<[^>\n]*>|\S+)'
+
+def find_macros(text):
+  
+  import re
+  
+  # [lower case name, first line, line after its ENDM] of each macro not
+  # defined inside another, counting lines from 0; only the lines with the
+  # words in them are matched, finding those is much quicker
+  lowered = text.lower()
+  starts = set()
+  for word in ['macro', 'endm', ]:
+    position = lowered.find(word)
+    while position >= 0:
+      starts.add(lowered.rfind('\n', 0, position) + 1)
+      position = lowered.find(word, position + 1)
+  pattern = re.compile(macro_pattern, re.M | re.I)
+  macros = []
+  depth = 0
+  line = 0
+  position = 0
+  for start in sorted(starts):
+    match = pattern.match(text, start)
+    if match is None:
+      continue
+    line += text.count('\n', position, start)
+    position = start
+    if match.group(2):
+      if depth == 0:
+        name = match.group(1).lower()
+        first = line
+      depth += 1
+    elif depth:
+      depth -= 1
+      if depth == 0:
+        macros.append([name, first, line + 1])
+  return macros
+
+# ----------------------------------------------
+def code_text(text):
+  
+  import re
+  
+  # without the comments, strings are kept as a ';' in one is not a comment
+  return re.sub(comment_pattern, lambda match: '' \
+                if match.group()[:1] == ';' else match.group(), text)
+
+# ----------------------------------------------
+def drop_unused_macros(pre, writer, text):
+  
+  import re, collections
+  
+  # returns the text without them, with the source map moved up to match
+  macros = find_macros(text)
+  if not macros:
+    return text
+  def count(code):
+    # every word, in lower case as the names are
+    return collections.Counter(re.findall(word_pattern, code))
+  
+  code = code_text(text)
+  lowered = code.lower()
+  total = count(lowered)
+  # names built with #v() could be any macro starting the same
+  if '#v(' in lowered:
+    for prefix in re.findall(r'([\w?]*)#v\(', lowered):
+      for name, first, end in macros:
+        if name.startswith(prefix):
+          total[name] += 1
+  # and the assembler reads the files it includes itself
+  pending = []
+  if 'include' in lowered:
+    pending = re.findall(include_pattern, code, re.M | re.I)
+  seen = set()
+  while pending:
+    filename = pending.pop().strip('"<>')
+    if filename in seen:
+      continue
+    seen.add(filename)
+    try:
+      entry = pre.load(filename, need_lines=True)
+    except Exception:
+      pre.opened_files[filename] = None
+      return text   # what it calls is not known
+    included = code_text(''.join(entry['lines']))
+    total.update(count(included.lower()))
+    pending += re.findall(include_pattern, included, re.M | re.I)
+  
+  lines = text.split('\n')
+  own = {}
+  for name, first, end in macros:
+    own.setdefault(name, collections.Counter()).update(
+      count(code_text('\n'.join(lines[first:end])).lower()))
+  # the ones only called from macros left out go next time round
+  dropped = set()
+  while True:
+    unused = [name for name in own \
+              if name not in dropped and total[name] == own[name][name]]
+    if not unused:
+      break
+    for name in unused:
+      dropped.add(name)
+      total.subtract(own[name])
+  if not dropped:
+    return text
+  
+  ranges = []
+  for name, first, end in macros:
+    if name in dropped:
+      if writer.notes:
+        lines[first] = '; PRE-PREPROCESSOR, left out unused macro: ' + name
+        first += 1
+      ranges.append((first, end))
+  if pre.stats is not None:
+    pre.stats.macros_dropped += len(dropped)
+  kept = []
+  position = 0
+  for first, end in ranges:
+    kept += lines[position:first]
+    position = end
+  kept += lines[position:]
+  writer.drop_lines([(first + 1, end + 1) for first, end in ranges])
+  return '\n'.join(kept)
+
+# -----------------------------------------------------------------------------
+# the pre-preprocessor as a library, everything one run keeps track of is kept
+# in one of these, so a program can import this file and run as many as it
+# wants; errors still end with SystemExit, as when run as a program
+
+class Preprocessor:
+  
+  def __init__(self, errfile=None, radix='hex', prune=True, analyzers=None,
+               stats=None, verbosity='full', memo=True, overlays=None,
+               prune_macros=False, prefetch=True):
+    self.ifstack = []
+    self.defines = {}
+    self.sections = {}
+    self.completed_sections = {}
+    self.errfile = errfile if errfile is not None else io.StringIO()
+    self.opened_files = {}    # every file opened, with its hash, size and mtime
+    self.writer = None        # the InterimWriter of the last run, for its map
+    # for working out #IF expressions
+    self.prune = prune        # leave out the branches known to not be taken
+    self.radix = radix        # 'hex', 'dec' or 'oct', None when not known
+    self.radix_volatile = False   # a macro changes the radix
+    self.symbols = {}         # by lower case name, [name, 'number' or 'text',
+                              # value] for each symbol known for sure
+    self.volatile = set()     # symbols a macro sets, never known for sure
+    self.ifprune = []         # True for each entry in ifstack that was pruned
+    self.bodies = []          # 'macro' and 'while' bodies being read
+    self.plain_ifs = 0        # MPASM conditionals without a '#' being read
+    self.analyzers = analyzers or []    # told of every directive handled
+    self.stats = stats        # a Stats to keep timings and counts in
+    self.verbosity = verbosity    # 'full', 'compact' leaves out the comments
+                                  # that only annotate, 'bare' also the blank
+                                  # and comment only lines of the source
+    self.guards = {}          # by absolute path, the include guard symbol
+                              # of each file read, or True if only once
+    self.memo = memo          # replay include expansions seen before
+    self.prune_macros = prune_macros  # leave out the macros never called
+    self.prefetch = prefetch  # read included files ahead on other threads
+    self.prefetcher = None    # the Prefetcher doing that, while running
+    self.recording = []       # the Expansion of each include being recorded
+    self.frames = []          # the ParseState of each file being parsed, the
+                              # top level file first
+    self.includes = []        # (absolute path, snapshot) of each
+                              # include being expanded, see check_include
+    self.overlays = {}        # by absolute path, entries read in place of
+                              # the files, see overlay()
+    for filename, text in (overlays or {}).items():
+      self.overlay(filename, text)
+  
+  def certain(self):
+    
+    # True when the line being read is assembled, and just once
+    return not self.bodies and not self.plain_ifs and all(self.ifprune)
+  
+  def assign(self, name, kind=None, value=None):
+    
+    # a symbol is being set, to a value that is not known if 'kind' is None
+    key = name.lower()
+    if self.recording:
+      self.seen('symbol', key)
+      self.changed('symbol', key)
+    if 'macro' in self.bodies:
+      self.volatile.add(key)
+    if kind is None or key in self.volatile or not self.certain():
+      self.symbols.pop(key, None)
+    else:
+      self.symbols[key] = [name, kind, value]
+  
+  def assign_expression(self, name, text):
+    
+    value = None
+    if self.prune and self.certain():
+      try:
+        value = evaluate(self, text)
+      except Unresolved:
+        pass
+    if value is None:
+      self.assign(name)
+    else:
+      self.assign(name, 'number', value)
+  
+  def set_radix(self, radix):
+    
+    if self.recording:
+      self.seen('radix', None)
+      self.changed('radix', None)
+    if 'macro' in self.bodies:
+      self.radix_volatile = True
+    if radix in radix_bases and self.certain() and not self.radix_volatile:
+      self.radix = radix
+    else:
+      self.radix = None
+  
+  def forget(self, summary, volatile=False):
+    
+    # what is in the summary of some lines not read here is not known any more
+    if self.recording:
+      for name in summary[0]:
+        self.seen('symbol', name.lower())
+        self.changed('symbol', name.lower())
+      if summary[2]:
+        self.seen('radix', None)
+        self.changed('radix', None)
+    for name in summary[0]:
+      self.symbols.pop(name.lower(), None)
+      if volatile:
+        self.volatile.add(name.lower())
+    if summary[2]:
+      self.radix = None
+      if volatile:
+        self.radix_volatile = True
+  
+  def forget_everything(self):
+    
+    # after a file MPASM may find where this can't, which could set anything
+    for expansion in self.recording:
+      expansion.cleared = True
+    self.changed('radix', None)
+    self.symbols.clear()
+    self.radix = None
+  
+  def forget_include(self, filename, seen, entry=None):
+    
+    # a file included that is not read here, nor anything it includes
+    if filename in seen:
+      return
+    seen.add(filename)
+    if entry is None:
+      try:
+        entry = self.load(filename)
+      except Exception:
+        self.opened_files[filename] = None
+        self.forget_everything()
+        return
+    self.forget(entry['summary'], volatile=True)
+    for name in entry['summary'][1]:
+      self.forget_include(name, seen)
+  
+  def forget_lines(self, lines):
+    
+    # lines written out without being read, like the GENERATE copies, where
+    # a name with a substitution in it could be anything
+    if not self.prune or not lines:
+      return
+    summary = summarize(split_lines(lines))
+    if any('{' in name for name in summary[0] + summary[1]):
+      self.forget_everything()
+    self.forget(summary)
+    for name in summary[1]:
+      self.forget_include(name, set())
+  
+  def define(self, predefines):
+    
+    # a dict of names and their values, or a list of names
+    if isinstance(predefines, dict):
+      predefines = predefines.items()
+    else:
+      predefines = [(name, None) for name in predefines]
+    for name, value in predefines:
+      self.defines[name.lower()] = value
+      self.assign(name, 'text', value)
+  
+  def preprocess(self, source, predefines=None, sink=None):
+    
+    # 'source' is a file name or a stream to read, the output goes to the
+    # stream 'sink', a new io.StringIO if not given, and that is returned
+    if predefines:
+      self.define(predefines)
+    if hasattr(source, 'read'):
+      filename = getattr(source, 'name', '<stream>')
+      lines = io.StringIO(source.read(), newline=None).readlines()
+      tokens = split_lines(lines)
+    else:
+      filename = os.fspath(source)
+      entry = self.load(filename, need_lines=True)
+      lines = entry['lines']
+      tokens = entry['tokens']
+    if sink is None:
+      sink = io.StringIO()
+    self.run(lines, tokens, InterimWriter(sink), filename)
+    return sink
+  
+  def overlay(self, filename, text):
+    
+    import hashlib, locale
+    
+    # the file is read as 'text' in this run, wherever it is included, such
+    # as an editor buffer not saved yet or a generated file
+    data = text.encode(locale.getpreferredencoding(False))
+    entry = split_file(data, hashlib.sha1(data).hexdigest(), True)
+    entry['size'] = len(data)
+    entry['mtime'] = None
+    self.overlays[os.path.abspath(filename)] = entry
+  
+  def load(self, filename, need_lines=False):
+    
+    # load_file for this run, timed for the stats
+    if self.overlays and os.path.abspath(filename) in self.overlays:
+      entry = self.overlays[os.path.abspath(filename)]
+      record_opened(self.opened_files, filename, entry)
+      if self.recording:
+        self.seen('file', filename, entry['hash'])
+      return entry
+    if self.stats is not None:
+      start = self.stats.clock()
+    try:
+      if self.prefetcher is not None:
+        self.prefetcher.wait(filename)
+      entry = load_file(filename, need_lines, self.opened_files)
+    except Exception:
+      if self.recording:
+        self.seen('file', filename, None)
+      raise
+    if self.stats is not None:
+      self.stats.loaded(filename, self.stats.clock() - start)
+    if self.recording:
+      self.seen('file', filename, entry['hash'])
+    return entry
+  
+  def snapshot(self):
+    
+    # everything that decides what an included file does
+    return (dict(self.defines), dict(self.symbols), set(self.volatile),
+            self.radix, self.radix_volatile, tuple(self.ifstack),
+            tuple(self.ifprune), tuple(self.bodies), self.plain_ifs,
+            dict(self.guards))
+  
+  def seen(self, kind, name, value=None):
+    
+    # the include expansions being recorded depend on this part of the state,
+    # a file's 'value' is its hash, None when it could not be opened
+    if kind != 'file':
+      value = self.current(kind, name)
+    for expansion in self.recording:
+      expansion.seen(kind, name, value)
+  
+  def changed(self, kind, name):
+    
+    for expansion in self.recording:
+      expansion.written.add((kind, name))
+  
+  def current(self, kind, name):
+    
+    # the part of the state an expansion can read or change, as a value kept
+    # with it, False for a name not defined
+    if kind == 'define':
+      return self.defines.get(name, False)
+    if kind == 'symbol':
+      entry = self.symbols.get(name)
+      return (None if entry is None else tuple(entry), name in self.volatile)
+    if kind == 'radix':
+      return (self.radix, self.radix_volatile)
+    if kind == 'guard':
+      return self.guards.get(name)
+    if kind == 'section':
+      if name not in self.sections:
+        return None
+      return 'done' if self.sections[name] is None else 'open'
+    if self.overlays and os.path.abspath(name) in self.overlays:
+      return self.overlays[os.path.abspath(name)]['hash']
+    try:
+      if self.prefetcher is not None:
+        self.prefetcher.wait(name)
+      return load_file(name)['hash']
+    except Exception:
+      return None
+  
+  def restore(self, kind, name, value):
+    
+    # sets what an expansion left in the state, as 'current' gave it
+    if kind == 'define':
+      if value is False:
+        self.defines.pop(name, None)
+      else:
+        self.defines[name] = value
+    elif kind == 'symbol':
+      if value[0] is None:
+        self.symbols.pop(name, None)
+      else:
+        self.symbols[name] = list(value[0])
+      if value[1]:
+        self.volatile.add(name)
+    elif kind == 'radix':
+      self.radix, self.radix_volatile = value
+    elif kind == 'guard':
+      self.guards[name] = value
+    self.changed(kind, name)
+  
+  def report(self):
+    
+    # what the analyzers found, by their names
+    report = {'version': report_version, }
+    for analyzer in self.analyzers:
+      report[analyzer.name] = analyzer.report()
+    return report
+  
+  def run(self, lines, tokens, writer, filename):
+    
+    # parses split up lines to the writer and checks every INSERT found its
+    # SECTION
+    self.writer = writer
+    writer.notes = self.verbosity == 'full'
+    if self.prefetch:
+      self.prefetcher = Prefetcher(self)
+    try:
+      if not self.prune_macros:
+        parse_file(self, lines, tokens, writer, filename)
+      else:
+        # kept in memory until the macros that are called are known
+        sink = writer.file
+        writer.file = io.StringIO()
+        try:
+          parse_file(self, lines, tokens, writer, filename)
+          text = drop_unused_macros(self, writer, writer.file.getvalue())
+        except BaseException:
+          sink.write(writer.file.getvalue())
+          raise
+        finally:
+          writer.file = sink
+        sink.write(text)
+    finally:
+      if self.prefetcher is not None:
+        self.prefetcher.stop()
+        self.prefetcher = None
+    for analyzer in self.analyzers:
+      analyzer.finish(self)
+    bail = False
+    for sectionName in self.sections:
+      if not self.sections[sectionName] is None:
+        bail = True
+        print('PRE ERROR: SECTION directive not found for section: ' + \
+              sectionName, file=sys.stderr)
+        while self.sections[sectionName]:
+          print('  macro to insert there: ' + \
+                heapq.heappop(self.sections[sectionName])[1], file=sys.stderr)
+    if bail:
+      sys.exit(1)
+
+# -----------------------------------------------------------------------------
+# daemon mode, with '--daemon' this keeps running and takes builds over a Unix
+# socket from mpasme_client.py, forking a copy of itself for each one, so the
+# files already read stay in memory between builds
+
+def serve():
+  
+  import socket, selectors, signal, pickle
+  
+  if not hasattr(os, 'fork') or not hasattr(socket, 'AF_UNIX'):
+    print('PRE-PREPROCESSOR ERROR: daemon mode needs fork and Unix sockets', \
+          file=sys.stderr)
+    sys.exit(1)
+  
+  path = daemon_socket if options['daemon'] is True else options['daemon']
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    server.connect(path)
+    print('PRE-PREPROCESSOR ERROR: daemon already running on ' + path, \
+          file=sys.stderr)
+    sys.exit(1)
+  except OSError:
+    server.close()
+  if os.path.exists(path):
+    os.remove(path)     # left behind by a daemon that was killed
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(path)
+  os.chmod(path, 0o600)
+  server.listen(16)
+  print('PRE INFO: daemon listening on ' + path, file=sys.stderr)
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  
+  program = program_id()
+  selector = selectors.DefaultSelector()
+  selector.register(server, selectors.EVENT_READ)
+  children = {}     # report pipe of each build running, to its pid and data
+  try:
+    while True:
+      for key, events in selector.select():
+        if key.fileobj is server:
+          conn = server.accept()[0]
+          if program_id() != program:
+            # this program was edited, the client runs the new one itself
+            # and the daemon starts again with it
+            conn.sendall(b'restart\n')
+            conn.close()
+            server.close()
+            os.remove(path)
+            os.execv(sys.executable, [sys.executable,
+                     script_file, ] + sys.argv[1:])
+          start_build(conn, server, children, selector)
+          continue
+        
+        data = os.read(key.fd, 1 << 20)
+        if data:
+          children[key.fd][1].append(data)
+          continue
+        selector.unregister(key.fd)
+        os.close(key.fd)
+        pid, chunks = children.pop(key.fd)
+        os.waitpid(pid, 0)
+        try:
+          memory_cache.update(pickle.loads(b''.join(chunks)))
+        except Exception:
+          pass      # the build died, it read nothing worth keeping
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if os.path.exists(path):
+      os.remove(path)
+  sys.exit(0)
+
+# ----------------------------------------------
+def start_build(conn, server, children, selector):
+  
+  import socket, selectors, json
+  
+  # the request is the client's arguments and working directory as a line of
+  # JSON, sent with its stdin, stdout and stderr
+  try:
+    data, fds, flags, address = socket.recv_fds(conn, 65536, 3)
+    while data and not data.endswith(b'\n'):
+      more = conn.recv(65536)
+      if not more:
+        break
+      data += more
+    request = json.loads(data.decode())
+  except Exception as msg:
+    print('PRE WARNING: bad daemon request: ' + str(msg), file=sys.stderr)
+    conn.close()
+    return
+  if len(fds) != 3:
+    for fd in fds:
+      os.close(fd)
+    conn.close()
+    return
+  
+  readfd, writefd = os.pipe()
+  sys.stdout.flush()
+  sys.stderr.flush()
+  pid = os.fork()
+  if pid == 0:
+    server.close()
+    for fd in list(children) + [readfd, ]:
+      os.close(fd)
+    run_build(conn, fds, request, writefd)
+  
+  os.close(writefd)
+  for fd in fds:
+    os.close(fd)
+  conn.close()
+  children[readfd] = [pid, []]
+  selector.register(readfd, selectors.EVENT_READ)
+
+# ----------------------------------------------
+def run_build(conn, fds, request, writefd):
+  
+  import traceback, signal, pickle
+  
+  # in the forked copy, build as if run by the client and send back the exit
+  # code, then the files read that the daemon did not already have
+  signal.signal(signal.SIGTERM, signal.SIG_DFL)
+  for target, fd in enumerate(fds):
+    os.dup2(fd, target)
+    os.close(fd)
+  before = dict(memory_cache)
+  try:
+    os.chdir(request['cwd'])
+    parse_arguments(request['argv'])
+    build()
+    exitcode = 0
+  except SystemExit as msg:
+    exitcode = msg.code
+    if exitcode is None:
+      exitcode = 0
+    elif not isinstance(exitcode, int):
+      print(exitcode, file=sys.stderr)
+      exitcode = 1
+  except BaseException:
+    traceback.print_exc()
+    exitcode = 1
+  try:
+    if errfile:
+      errfile.close()
+    sys.stdout.flush()
+    sys.stderr.flush()
+  except Exception:
+    pass
+  try:
+    conn.sendall(('exit ' + str(exitcode) + '\n').encode())
+  except OSError:
+    pass
+  conn.close()
+  
+  loaded = {path: entry for path, entry in memory_cache.items() \
+            if before.get(path) is not entry}
+  try:
+    with os.fdopen(writefd, 'wb') as f:
+      pickle.dump(loaded, f, pickle.HIGHEST_PROTOCOL)
+  except Exception:
+    pass
+  os._exit(0)
+
+# -----------------------------------------------------------------------------
+# watch mode, with '--watch' this keeps running and builds again whenever a
+# file the last build opened changes, so the interim file, its manifest and
+# the assembler result are ready before the IDE asks for them
+
+watch_delay = 0.2       # seconds without changes before building
+watch_interval = 0.5    # seconds between looking at the files when polling
+
+class InotifyWatcher:
+  
+  # the directories of the files are watched, since editors often save by
+  # writing a new file and renaming it over the old one
+  
+  mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200   # modify, attrib,
+                          # close write, moved from, moved to, create, delete
+  
+  def __init__(self):
+    import ctypes, ctypes.util
+    self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    self.directories = {}   # by watch descriptor
+    self.paths = set()
+  
+  def watch(self, paths):
+    self.paths = set(paths)
+    wanted = set(os.path.dirname(path) for path in self.paths)
+    for wd, directory in list(self.directories.items()):
+      if directory not in wanted:
+        self.libc.inotify_rm_watch(self.fd, wd)
+        del self.directories[wd]
+    for directory in wanted - set(self.directories.values()):
+      wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                       self.mask)
+      if wd >= 0:   # a directory not there can't have the file made in it
+        self.directories[wd] = directory
+  
+  def wait(self, timeout):
+    import select, struct
+    # True when one of the files changed
+    if not select.select([self.fd, ], [], [], timeout)[0]:
+      return False
+    changed = False
+    while True:
+      try:
+        data = os.read(self.fd, 65536)
+      except BlockingIOError:
+        return changed
+      position = 0
+      while position < len(data):
+        wd, mask, cookie, length = struct.unpack_from('iIII', data, position)
+        name = data[position + 16:position + 16 + length].rstrip(b'\0')
+        position += 16 + length
+        if mask & 0x4000:     # events were lost
+          changed = True
+        elif wd in self.directories and os.path.join(
+               self.directories[wd], os.fsdecode(name)) in self.paths:
+          changed = True
+        elif mask & 0x8000:   # the directory went away
+          self.directories.pop(wd, None)
+  
+  def close(self):
+    os.close(self.fd)
+
+# ----------------------------------------------
+class PollWatcher:
+  
+  # where there is no inotify, the size and time of each file is looked at
+  
+  def __init__(self):
+    self.states = {}
+  
+  def watch(self, paths):
+    # files watched already keep their old state, a change is not missed
+    states = output_states(paths)
+    states.update((path, self.states[path]) for path in paths \
+                  if path in self.states)
+    self.states = states
+  
+  def wait(self, timeout):
+    import time
+    time.sleep(min(timeout, watch_interval))
+    states = output_states(self.states)
+    changed = states != self.states
+    self.states = states
+    return changed
+  
+  def close(self):
+    pass
+
+# ----------------------------------------------
+def watched_files(previous):
+  
+  import json
+  
+  # every file the last builds opened, or tried to, from their manifests,
+  # the ones watched before if a build failed
+  if len(inputfilenames) > 1:
+    manifests = [os.path.join(options.get('interim-dir', ''), name) + \
+                 '.manifest' for name in batch_interim_files()]
+  else:
+    manifests = [manifest_file, ]
+  paths = set(os.path.abspath(filename.strip('"')) \
+              for filename in inputfilenames)
+  for filename in manifests:
+    try:
+      with open(filename, 'r') as f:
+        files = json.load(f)['files']
+    except Exception:
+      return previous | paths
+    paths.update(os.path.abspath(path) for path in files)
+  return paths
+
+# ----------------------------------------------
+def start_watch_build(command):
+  
+  import subprocess
+  
+  # in its own process group, so stopping it stops the assembler too
+  if hasattr(os, 'killpg'):
+    return subprocess.Popen(command, start_new_session=True)
+  return subprocess.Popen(command)
+
+# ----------------------------------------------
+def stop_watch_build(proc):
+  
+  import signal
+  
+  try:
+    if hasattr(os, 'killpg'):
+      os.killpg(proc.pid, signal.SIGTERM)
+    else:
+      proc.terminate()
+  except OSError:
+    pass
+  proc.wait()
+  try:
+    os.remove(interim_file + '.' + str(proc.pid))   # what it was writing
+  except OSError:
+    pass
+
+# ----------------------------------------------
+def watch():
+  
+  import time, signal
+  
+  command = [sys.executable, script_file, ] + inputfilenames
+  command += ['--' + name + ('' if value is True else '=' + value) \
+              for name, value in options.items() if name not in ['watch', ]]
+  command += passed_options
+  
+  try:
+    watcher = InotifyWatcher()
+  except (OSError, AttributeError):
+    watcher = PollWatcher()
+  signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+  
+  paths = watched_files(set())
+  watcher.watch(paths)
+  proc = None
+  due = time.monotonic()    # when to build next, None until a change
+  try:
+    while True:
+      if proc is not None and proc.poll() is not None:
+        print('PRE INFO: watch: build done, exit code ' + \
+              str(proc.returncode), file=sys.stderr)
+        proc = None
+        paths = watched_files(paths)
+        watcher.watch(paths)
+      
+      if due is not None and time.monotonic() >= due:
+        due = None
+        proc = start_watch_build(command)
+      
+      timeout = watch_interval if due is None else \
+                max(due - time.monotonic(), 0)
+      if watcher.wait(timeout):
+        if proc is not None:
+          # what it is building is already out of date
+          stop_watch_build(proc)
+          proc = None
+          print('PRE INFO: watch: stopped build, files changed', \
+                file=sys.stderr)
+        due = time.monotonic() + watch_delay
+  except KeyboardInterrupt:
+    pass
+  finally:
+    if proc is not None:
+      stop_watch_build(proc)
+    watcher.close()
+  sys.exit(0)
+
+# -----------------------------------------------------------------------------
+def build():
+  
+  global inputfilename
+  
+  if not inputfilename:
+    print("no file specified")
+    sys.exit(1)
+  
+  if 'matrix' in options:
+    sys.exit(run_matrix())
+  if len(inputfilenames) > 1:
+    sys.exit(run_batch())
+  
+  # the filename is coming in with quotes on it
+  if inputfilename[:1] == '"':
+    inputfilename = inputfilename.strip('"')
+  
+  if '.' in inputfilename:
+    basename = inputfilename.split('.')[0]
+  else:
+    basename = inputfilename
+  # the error file goes with the interim file when that has its own name or
+  # place, so builds in the same directory don't share it
+  if 'interim-dir' in options or options.get('interim') == 'auto':
+    basename = os.path.splitext(interim_file)[0]
+  if 'interim-dir' in options:
+    try:
+      os.makedirs(options['interim-dir'], exist_ok=True)
+    except Exception as msg:
+      print("failed to create interim directory, error: " + str(msg))
+      sys.exit(1)
+  
+  mpasm_args = mpasm_options()
+  chain = mpasm_prog and 'no-chain' not in options
+  # held for the rest of the build, see lock_interim
+  lock = lock_interim()
+  try:
+    build_interim(basename, mpasm_args, chain)
+  finally:
+    if lock is not None:
+      lock.close()
+
+# ----------------------------------------------
+def build_interim(basename, mpasm_args, chain):
+  
+  global errfile
+  
+  proc = None
+  stats = Stats() if 'stats' in options else None
+  verbosity = options.get('verbosity', 'full')
+  if verbosity not in ['full', 'compact', 'bare', ]:
+    print('PRE-PREPROCESSOR ERROR: verbosity is full, compact or bare, not: ' + \
+          str(verbosity), file=sys.stderr)
+    sys.exit(1)
+  
+  if 'rebuild' not in options and manifest_valid():
+    
+    try:
+      errfile = open(basename + '.pre.ERR', 'w')
+    except Exception as msg:
+      print("failed to create error file, error: " + str(msg))
+      sys.exit(1)
+    
+    print('PRE INFO: interim file is up to date, chaining to assembler', \
+          file=sys.stderr)
+  
+  else:
+    
+    # a failed run must not leave a manifest or source map behind for the old
+    # interim file
+    for filename in [manifest_file, source_map_file, analysis_file, ]:
+      if os.path.exists(filename):
+        os.remove(filename)
+    
+    pre = Preprocessor(radix=mpasm_radix(), prune='no-prune' not in options,
+                       stats=stats, verbosity=verbosity,
+                       memo='no-replay' not in options,
+                       prune_macros='prune-macros' in options,
+                       prefetch='no-prefetch' not in options)
+    if 'analyze' in options:
+      pre.analyzers = default_analyzers()
+    pre.define(option_defines())
+    try:
+      entry = pre.load(inputfilename, need_lines=True)
+    except Exception as msg:
+      print("failed to import file, error: " + str(msg))
+      print("failed to import file: " + str(inputfilename))
+      sys.exit(1)
+    
+    if chain and 'pipe' in options and hasattr(os, 'mkfifo'):
+      try:
+        proc, pipefile = start_pipe(mpasm_args)
+      except Exception as msg:
+        print("failed to create output pipe, error: " + str(msg))
+        sys.exit(1)
+      if pipefile is None:
+        print('MPASM returned before reading the interim file: ' + \
+              str(proc.returncode), file=sys.stderr)
+        remove_fifo()
+        sys.exit(proc.returncode or 1)
+      outfile = InterimWriter(pipefile)
+    else:
+      remove_fifo()     # left behind by a run with --pipe
+      try:
+        # written under another name and moved into place, so the assembler
+        # never reads one half written
+        tempfn = interim_file + '.' + str(os.getpid())
+        outfile = InterimWriter(open(tempfn, 'w'))
+      except Exception as msg:
+        print("failed to create output file, error: " + str(msg))
+        sys.exit(1)
+    
+    try:
+      errfile = open(basename + '.pre.ERR', 'w')
+    except Exception as msg:
+      print("failed to create error file, error: " + str(msg))
+      if proc:
+        stop_pipe(proc)
+      sys.exit(1)
+    
+    pre.errfile = errfile
+    try:
+      pre.run(entry['lines'], entry['tokens'], outfile, inputfilename)
+      outfile.close()
+    except BrokenPipeError:
+      # MPASM stopped reading, its exit code will say why
+      print('PRE WARNING: assembler stopped reading the interim file', \
+            file=sys.stderr)
+      try:
+        outfile.close()
+      except OSError:
+        pass
+    except BaseException:
+      if proc:
+        stop_pipe(proc)
+      else:
+        # left as far as it got, with the error in it
+        outfile.close()
+        os.replace(tempfn, interim_file)
+      raise
+    if proc is None:
+      os.replace(tempfn, interim_file)
+    
+    if 'cache-stats' in options:
+      print('PRE INFO: include cache: ' + str(cache_hits) + ' hits, ' + \
+            str(cache_misses) + ' misses', file=sys.stderr)
+    
+    if 'analyze' in options:
+      for analyzer in pre.analyzers:
+        for message in analyzer.findings():
+          print('PRE WARNING: ' + message, file=sys.stderr)
+      write_report(pre, analysis_file)
+    if 'no-source-map' not in options:
+      write_source_map(outfile)
+    if proc is None:
+      write_manifest(pre.opened_files)
+      if stats is not None:
+        stats.interim_bytes = os.path.getsize(interim_file)
+    
+    print('PRE INFO: pre-preprocessor completed, chaining to assembler', \
+          file=sys.stderr)
+  
+  # ---------------------------------------------
+  # pass generated output to assembler program
+  if chain:
+    
+    if stats is not None:
+      started = stats.clock()
+    if proc is None:
+      key = None
+      exitcode = None
+      if cache_dir and 'no-result-cache' not in options:
+        key = result_key(mpasm_args)
+      if key:
+        exitcode = restore_result(key)
+        if exitcode is not None:
+          print('PRE INFO: assembler result restored from cache', \
+                file=sys.stderr)
+      
+      if exitcode is None:
+        import subprocess
+        before = output_states(result_outputs(mpasm_args))
+        proc = subprocess.Popen(mpasm_command(mpasm_args))
+        exitcode = proc.wait()
+        if key:
+          store_result(key, before, exitcode)
+    
+    else:
+      # already running on the pipe
+      exitcode = proc.wait()
+      remove_fifo()
+    if stats is not None:
+      stats.assembler = stats.clock() - started
+      write_stats(stats, stats_file)
+    
+    if 'no-source-map' not in options:
+      source_map = load_source_map()
+      if source_map:
+        rewrite_outputs(source_map, mpasm_args)
+    
+    if exitcode != 0:
+      print('MPASM returned non-zero: ' + str(exitcode), file=sys.stderr)
+      sys.exit(exitcode)
+  
+  else:
+    if stats is not None:
+      write_stats(stats, stats_file)
+    sys.exit(0)
+
+# -----------------------------------------------------------------------------
+def main(argv=None):
+  
+  parse_arguments(sys.argv[1:] if argv is None else argv)
+  if 'version' in options:
+    print(os.path.basename(script_file) + ' ' + program_version)
+    sys.exit(0)
+  if 'daemon' in options:
+    serve()
+  if 'watch' in options:
+    watch()
+  build()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+'''
+Tests for the pre-preprocessor, run with pytest.
+GPLv3
+'''
+
+
+import io
+import pytest
+import mpasme
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+  
+  # writes the files given, by name, in a directory of its own and
+  # preprocesses the first one, without the caches, returning the output
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setattr(mpasme, 'cache_dir', None)
+  monkeypatch.setattr(mpasme, 'memory_cache', {})
+  monkeypatch.setattr(mpasme, 'expansions', {})
+  def run(files, **settings):
+    for name, text in files.items():
+      (tmp_path / name).write_text(text)
+    pre = mpasme.Preprocessor(**settings)
+    return pre.preprocess(next(iter(files))).getvalue()
+  return run
+
+# -----------------------------------------------------------------------------
+def test_force_expansion_marker_is_special():
+  
+  assert mpasme.scan_special(b';#sectioninsert_force_expansion\n nop\n')
+  assert not mpasme.scan_special(b'; not a marker\n nop\n')
+
+# ----------------------------------------------
+def test_force_expansion_marker_expands_include(tmp_path, monkeypatch):
+  
+  # an included file with nothing special in it but the marker is expanded
+  # into the interim file rather than left for the assembler
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setattr(mpasme, 'cache_dir', None)
+  (tmp_path / 'forced.inc').write_text(';#sectioninsert_force_expansion\n' + \
+                                       '\tnop\n')
+  (tmp_path / 'top.asm').write_text('#include forced.inc\n\tend\n')
+  pre = mpasme.Preprocessor(prefetch=False)
+  text = pre.preprocess('top.asm').getvalue()
+  assert '; PRE-PREPROCESSOR, including: forced.inc' in text
+  assert '\tnop\n' in text
+
+# ----------------------------------------------
+def test_include_cycle_found_on_first_repeat(project):
+  
+  errors = io.StringIO()
+  with pytest.raises(SystemExit):
+    project({'top.asm': '#include b.inc\n\tend\n',
+             'b.inc': '#include c.inc\n#SECTION s\n',
+             'c.inc': '#INSERT m s\n#include b.inc\n', }, errfile=errors)
+  report = errors.getvalue()
+  assert 'include cycle, b.inc' in report
+  # the chain goes round once, top.asm, b.inc, c.inc and then b.inc again
+  assert report.count('- file: b.inc') == 2
+
+# ----------------------------------------------
+def test_include_recursion_that_ends_is_expanded(project):
+  
+  text = project({'top.asm': '#define N\n#include r.inc\n\tend\n',
+                  'r.inc': '#ifdef N\n#undefine N\n#INSERT m s\n' + \
+                           '#include r.inc\n#endif\n#SECTION s\n', })
+  assert text.count('; PRE-PREPROCESSOR, including: r.inc') == 2
+
+# ----------------------------------------------
+def test_main_can_run_again(tmp_path, monkeypatch):
+  
+  # nothing one run was given is kept for the next
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setattr(mpasme, 'memory_cache', {})
+  (tmp_path / 'out').mkdir()
+  (tmp_path / 'top.asm').write_text('\tnop\n\tend\n')
+  for arguments in [['--interim-dir=out', '--no-cache'],
+                    ['--interim-dir=out', '--no-cache'], ['--version']]:
+    with pytest.raises(SystemExit) as exit:
+      mpasme.main(['top.asm', '--no-chain', ] + arguments)
+    assert not exit.value.code
+  assert (tmp_path / 'out' / '_pre_processed_file.asm').exists()
+  assert not (tmp_path / 'out' / 'out').exists()
+  assert mpasme.interim_file == mpasme.default_interim_file
+  assert mpasme.cache_dir == mpasme.default_cache_dir
+
+# ----------------------------------------------
+def test_result_key_covers_files_left_for_mpasm(tmp_path, monkeypatch):
+  
+  monkeypatch.chdir(tmp_path)
+  monkeypatch.setattr(mpasme, 'mpasm_prog', str(tmp_path / 'mpasmx'))
+  monkeypatch.setattr(mpasme, 'interim_file', 'interim.asm')
+  (tmp_path / 'mpasmx').write_text('')
+  (tmp_path / 'interim.asm').write_text('\t#include "a.inc"\n\tend\n')
+  (tmp_path / 'a.inc').write_text('\tinclude <b.inc> ; nested\n')
+  (tmp_path / 'b.inc').write_text('x equ 1\n')
+  key = mpasme.result_key([])
+  assert key and key == mpasme.result_key([])
+  (tmp_path / 'b.inc').write_text('x equ 2 ; changed\n')
+  assert mpasme.result_key([]) not in [None, key]
+  (tmp_path / 'b.inc').unlink()
+  assert mpasme.result_key([]) is None
+
+# ----------------------------------------------
+@pytest.mark.parametrize('marker', ['#ifndef G\n#define G\n',
+                                    ';#sectioninsert_include_once\n'])
+def test_include_read_once_is_skipped_after(project, marker):
+  
+  end = '#endif\n' if marker[:1] == '#' else ''
+  text = project({'top.asm': '#include g.inc\n#include g.inc\n' + \
+                             '#SECTION s\n\tend\n',
+                  'g.inc': marker + '#INSERT m s\n' + end, })
+  assert text.count('; PRE-PREPROCESSOR, including: g.inc') == 1
+  assert 'skipping included file read already: g.inc' in text
+
+# ----------------------------------------------
+@pytest.mark.parametrize('marker', ['#ifndef G\n#define G\n',
+                                    ';#sectioninsert_include_once\n'])
+@pytest.mark.parametrize('special', ['#INSERT m s\n', '\tnop\n'])
+def test_include_under_unresolved_if_is_not_read_once(project, marker,
+                                                      special):
+  
+  # the assembler may not read it the first time, so the second include
+  # is kept, expanded or left for the assembler
+  end = '#endif\n' if marker[:1] == '#' else ''
+  text = project({'top.asm': '#if UNKNOWN\n#include g.inc\n#endif\n' + \
+                             '#include g.inc\n#SECTION s\n\tend\n',
+                  'g.inc': marker + special + end, })
+  assert 'read already' not in text
+  if special[:1] == '#':
+    assert text.count('; PRE-PREPROCESSOR, including: g.inc') == 2
+  else:
+    assert text.count('\n#include g.inc\n') == 2
+
+# ----------------------------------------------
+@pytest.mark.parametrize('expression, taken', [
+  ['A + 1 == 4', True], ['A * 2 != 6', False], ['0x10 == .16', True],
+  ["H'1F' == .31", True], ['A > 2 && A < 3', False], ['!(A - 3)', True],
+  ['low 0x1234 == 0x34', True], ['high 0x1234 == 0x12', True],
+  ['(1 << 4) | 1 == 17', True], ['defined(A)', True], ])
+def test_if_worked_out_is_pruned(project, expression, taken):
+  
+  text = project({'top.asm': '#define A 3\n#if ' + expression + '\n' + \
+                             '\tnop ; then\n#else\n\tnop ; otherwise\n' + \
+                             '#endif\n\tend\n', })
+  assert '; PRE-PREPROCESSOR, pruned: #if ' + expression in text
+  assert ('; then' in text) == taken
+  assert ('; otherwise' in text) != taken
+
+# ----------------------------------------------
+@pytest.mark.parametrize('before', [
+  '', 'm macro\nX set 1\n\tendm\nX set 2\n',
+  '\tif COND\nX set 1\n\tendif\n', '\twhile 0\nX set 1\n\tendw\n',
+  'X set 1\nX = Y\n', ])
+def test_if_not_known_is_left_for_mpasm(project, before):
+  
+  # the symbol isn't set, or is set where the assembler may not take it
+  text = project({'top.asm': before + '#if X == 1\n\tnop ; then\n' + \
+                             '#endif\n\tend\n', })
+  assert 'pruned' not in text
+  assert '#if X == 1\n' in text
+
+# ----------------------------------------------
+def test_radix_is_followed(project):
+  
+  text = project({'top.asm': '\tradix dec\n#if 10 == 0x0A\n\tnop ; then\n' + \
+                             '#endif\n\tend\n', })
+  assert 'pruned: #if 10 == 0x0A taken' in text
+
+# ----------------------------------------------
+@pytest.mark.parametrize('before, directive, taken', [
+  ['#define B\n', '#ifdef B', True], ['#define B 5\n', '#ifndef B', False],
+  ['#define B\n#undefine B\n', '#ifdef B', None],
+  ['B equ 5\n', '#ifdef B', None], ['B set 5\n', '#ifndef B', None],
+  ['V = 3\n', '#ifndef V', None], ['', '#ifdef B', None],
+  ['B equ 5\n', '#if defined(B)', None], ])
+def test_ifdef_pruned_only_for_defines(project, before, directive, taken):
+  
+  text = project({'top.asm': before + directive + '\n\tnop ; then\n' + \
+                             '#endif\n\tend\n', })
+  if taken is None:
+    assert 'pruned' not in text
+    assert directive + '\n' in text
+  else:
+    assert 'pruned: ' + directive in text
+    assert ('; then' in text) == taken
+
+# ----------------------------------------------
+@pytest.mark.parametrize('files', [
+  # the same state each time
+  {'top.asm': '#include a.inc\n#include a.inc\n#SECTION s\n\tend\n',
+   'a.inc': '#INSERT m s\n\tnop\n#ifdef F\n\tclrw\n#endif\n', },
+  # a symbol it reads changes in between
+  {'top.asm': '#include a.inc\n#define F\n#include a.inc\n#undefine F\n' + \
+              '#include a.inc\n#SECTION s\n\tend\n',
+   'a.inc': '#INSERT m s\n#ifdef F\n\tclrw\n#else\n\tnop\n#endif\n', },
+  # it changes what the next include and the file after it read
+  {'top.asm': '#define N 1\n#include a.inc\n#include a.inc\n#if N == 3\n' + \
+              '\tnop\n#endif\n#SECTION s\n\tend\n',
+   'a.inc': '#if N == 1\n#undefine N\n#define N 2\n#else\n#undefine N\n' + \
+            '#define N 3\n#endif\n#INSERT m s\n\tmovlw N\n', },
+  # nested, with a section the inner file fills
+  {'top.asm': '#include a.inc\n#include a.inc\n#SECTION s\n#SECTION t\n' + \
+              '\tend\n',
+   'a.inc': '#include b.inc\n#INSERT m t\n\tclrf x\n',
+   'b.inc': '#INSERT m s\n\tnop\n', },
+])
+def test_replay_matches_fresh_build(project, monkeypatch, files):
+  
+  # whether an include is written from a recording, in the same build or the
+  # next one, the interim file is the one a build without replay writes
+  replayed = []
+  replay = mpasme.replay_expansion
+  def counted(*arguments):
+    replayed.append(arguments)
+    replay(*arguments)
+  monkeypatch.setattr(mpasme, 'replay_expansion', counted)
+  fresh = project(files, memo=False, prefetch=False)
+  assert not replayed
+  assert project(files, prefetch=False) == fresh
+  assert project(files, prefetch=False) == fresh
+  assert replayed
+
+# ----------------------------------------------
+def test_replay_from_the_include_cache(project, tmp_path, monkeypatch):
+  
+  files = {'top.asm': '#define F\n#include a.inc\n#SECTION s\n\tend\n',
+           'a.inc': '#INSERT m s\n#ifdef F\n\tclrw\n#endif\n\tnop\n', }
+  fresh = project(files, memo=False, prefetch=False)
+  monkeypatch.setattr(mpasme, 'cache_dir', str(tmp_path / 'cache'))
+  assert project(files, prefetch=False) == fresh
+  # a new process, with only what was kept on disk
+  monkeypatch.setattr(mpasme, 'expansions', {})
+  monkeypatch.setattr(mpasme, 'memory_cache', {})
+  replayed = []
+  replay = mpasme.replay_expansion
+  def counted(*arguments):
+    replayed.append(arguments)
+    replay(*arguments)
+  monkeypatch.setattr(mpasme, 'replay_expansion', counted)
+  assert project(files, prefetch=False) == fresh
+  assert replayed
+
+# ----------------------------------------------
+@pytest.mark.parametrize('files, kept', [
+  [{'top.asm': '\tkept\n', }, ['kept', 'keep1']],
+  [{'top.asm': '\tnop ; kept\n', }, []],
+  [{'top.asm': '\tdata "kept"\n', }, ['kept', 'keep1']],
+  [{'top.asm': '#INSERT kept s\n#SECTION s\n', }, ['kept', 'keep1']],
+  [{'top.asm': '\tkeep#v(1)\n', }, ['keep1']],
+  [{'top.asm': '\tother#v(1)\n', }, []],
+  [{'top.asm': '#include lib.inc\n', 'lib.inc': '\tkept\n', },
+   ['kept', 'keep1']],
+  [{'top.asm': '#include lib.inc\n',
+    'lib.inc': '\tinclude "deep.inc"\n', 'deep.inc': '\tkept\n', },
+   ['kept', 'keep1']],
+  [{'top.asm': '#include lib.inc\n', 'lib.inc': '\tnop\n', }, []],
+  [{'top.asm': '\tinclude missing.inc\n', }, ['kept', 'keep1', 'unused']],
+])
+def test_prune_macros_keeps_what_could_be_called(project, files, kept):
+  
+  # 'keep1' is called only by 'kept' and itself, and 'unused' only by itself
+  macros = 'kept macro\n\tkeep1\n\tendm\n' + \
+           'keep1 macro\n\tkeep1\n\tendm\n' + \
+           'unused macro\n\tunused\n\tendm\n'
+  files = dict(files, **{'top.asm': macros + files['top.asm'] + '\tend\n'})
+  text = '\n' + project(files, prune_macros=True)
+  for name in ['kept', 'keep1', 'unused', ]:
+    assert ('\n' + name + ' macro' in text) == (name in kept)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+'''
+Synthetic project generator for the pre-preprocessor.
+GPLv3
+
+Writes a project laid out like a real one, a top file including a header of
+'set' and 'equ' lines, framework files each with a chain of nested includes
+under it, INSERT directives at random priorities into the sections, GENERATE
+blocks, and a core file with the SECTION directives and their SPLICE blocks.
+The same settings and seed always give the same project.
+
+  workload.py directory [--levels=N] [--frameworks=N] [--sections=N]
+              [--inserts=N] [--generate=N] [--equs=N] [--lines=N] [--seed=N]
+
+It can also be imported, benchmark.py uses write_project().
+'''
+
+
+import sys, os, random
+
+# the settings and their defaults
+defaults = {
+  'levels': 3,          # includes nested under each framework file
+  'frameworks': 8,      # framework files included by the top file
+  'sections': 6,        # sections, each with its SECTION in the core file
+  'inserts': 8,         # INSERT directives in each framework file
+  'generate': 64,       # iterations of the GENERATE block in each file
+  'equs': 400,          # 'set' and 'equ' lines in the header
+  'lines': 2000,        # plain lines in each framework and nested file
+  'seed': 1,
+}
+
+# -----------------------------------------------------------------------------
+def write_lines(directory, filename, lines):
+  
+  with open(os.path.join(directory, filename), 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  return len(lines)
+
+# ----------------------------------------------
+def filler(rng, name, count):
+  
+  # plain instructions, labels and comments, with the odd conditional
+  lines = []
+  for number in range(count):
+    if number % 200 == 0:
+      lines.append('#ifdef ' + name + '_option_' + str(number % 3))
+    elif number % 200 == 100:
+      lines.append('#endif')
+    elif number % 50 == 0:
+      lines.append(name + '_label_' + str(number))
+    elif number % 7 == 0:
+      lines.append('; ' + name + ' table entry ' + str(number))
+    elif number % 2:
+      lines.append('\tmovlw\t0x' + format(rng.randrange(256), '02X'))
+    else:
+      lines.append('\tmovwf\tPOSTINC0')
+  if count % 200 and count % 200 <= 100:
+    lines.append('#endif')    # closes the last one when it stops early
+  return lines
+
+# ----------------------------------------------
+def write_project(directory, **settings):
+  
+  # returns the name of the top file and the number of lines written
+  for name in settings:
+    if name not in defaults:
+      raise ValueError('unknown workload setting: ' + name)
+  settings = dict(defaults, **settings)
+  rng = random.Random(settings['seed'])
+  total = 0
+  
+  lines = ['; header of assembler settings']
+  for number in range(settings['equs']):
+    keyword = 'equ' if number % 3 else 'set'
+    lines.append('HDR_VALUE_' + str(number) + '\t' + keyword + '\t0x' + \
+                 format(rng.randrange(65536), '04X'))
+    if number % 40 == 0:
+      lines.append('#define HDR_FLAG_' + str(number))
+  total += write_lines(directory, 'header.inc', lines)
+  
+  top = ['\tlist\tp=18f4550', '#define fw_option_1', '#include header.inc', ]
+  for framework in range(settings['frameworks']):
+    name = 'fw' + str(framework)
+    top.append('#include ' + name + '.inc')
+    
+    # the chain of nested includes under it, deepest first
+    for level in range(settings['levels'], 0, -1):
+      macro = name + '_' + str(level) + '_isr'
+      lines = [macro + '\tmacro', '\tnop', '\tendm',
+               '#INSERT ' + macro + ' section_' + \
+               str(rng.randrange(settings['sections'])) + ' ' + \
+               str(rng.randrange(1, 200)), ]
+      if level < settings['levels']:
+        lines.append('#include ' + name + '_' + str(level + 1) + '.inc')
+      lines += filler(rng, name + '_' + str(level), settings['lines'])
+      total += write_lines(directory, name + '_' + str(level) + '.inc', lines)
+    
+    lines = ['#include ' + name + '_1.inc', ]
+    for insert in range(settings['inserts']):
+      macro = name + '_isr_' + str(insert)
+      lines += [macro + '\tmacro', '\tbcf\tPIR1, ' + str(insert % 8),
+                '\tendm', ]
+      lines.append('#INSERT ' + macro + ' section_' + \
+                   str(rng.randrange(settings['sections'])) + ' ' + \
+                   str(rng.randrange(1, 200)))
+    lines.append('#GENERATE 0 ' + str(settings['generate'] - 1))
+    lines += [name + '_entry_{iii}', '\tmovlw\t{i*2+1}',
+              '\tmovwf\t' + name + '_table + {i}', ]
+    lines.append('#ENDGEN')
+    lines += filler(rng, name, settings['lines'])
+    total += write_lines(directory, name + '.inc', lines)
+  
+  lines = ['; the sections']
+  for section in range(settings['sections']):
+    if section % 2 == 0:
+      lines += ['#SPLICEBEFORE', '\tmovlb\t' + str(section), '#ENDSPLICE',
+                '#SPLICEBETWEEN', '\tbtfsc\tINTCON, {i}', '#ENDSPLICE',
+                '#SPLICEAFTER', '\tretfie\tFAST', '#ENDSPLICE', ]
+    lines.append('#SPLICEEMPTY')
+    lines.append('\tnop')
+    lines.append('#ENDSPLICE')
+    lines.append('#SECTION section_' + str(section))
+  total += write_lines(directory, 'core.inc', lines)
+  
+  top += ['#include core.inc', '\tend', ]
+  total += write_lines(directory, 'project.asm', top)
+  return 'project.asm', total
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+  
+  directory = None
+  settings = {}
+  for entry in sys.argv[1:]:
+    if entry[:2] == '--':
+      name, sep, value = entry[2:].partition('=')
+      settings[name] = int(value)
+    else:
+      directory = entry
+  
+  if not directory:
+    print('no directory specified')
+    sys.exit(1)
+  os.makedirs(directory, exist_ok=True)
+  try:
+    top, total = write_project(directory, **settings)
+  except ValueError as msg:
+    print(str(msg))
+    sys.exit(1)
+  print(os.path.join(directory, top) + ': ' + str(total) + ' lines')